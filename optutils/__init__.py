@@ -5,5 +5,7 @@
 #For licensing see the LICENSE file in the top level directory.
 
 from util import main, custom_log_main
-from lib import log, output, error_codes, add_code
+from lib import log, output, output_many, error_codes, add_code
+from lib import buffer_output, buffer_log, unbuffer, flush
+from lib import Logger
 
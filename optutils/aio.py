@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#Author: Tim Henderson
+#Email: tim.tadh@gmail.com
+#For licensing see the LICENSE file in the top level directory.
+
+'''asyncio support. Commands may be coroutine functions: main, custom_log_main
+and Util.command run them on the event loop. The blocking helpers have
+counterparts here which run in a thread and return futures to wait on.
+
+This needs asyncio, or on python 2 its backport trollius. Without either,
+commands are run as they always were and the helpers raise ImportError.
+
+ex.
+    @optutils.main(...)
+    @asyncio.coroutine
+    def main(argv, util, parser):
+        a, b = yield From(asyncio.gather(
+            util.read_file_async(argv[0]),
+            util.read_file_async(argv[1]),
+        ))
+        yield From(aio.output(len(a) + len(b)))
+'''
+
+import functools
+
+from . import lib
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+def iscoroutinefunction(f):
+    return asyncio is not None and asyncio.iscoroutinefunction(f)
+
+def iscoroutine(obj):
+    return asyncio is not None and asyncio.iscoroutine(obj)
+
+def require():
+    if asyncio is None:
+        raise ImportError('asyncio (or trollius on python 2) is required')
+
+def synchronous(f):
+    '''Wrap the coroutine function f so calling it runs it to completion on
+    the event loop. When the loop is already running (a command run by an
+    async command) the coroutine is returned for the caller to wait on.'''
+    require()
+    @functools.wraps(f)
+    def run(*args, **kwargs):
+        loop = asyncio.get_event_loop()
+        coroutine = f(*args, **kwargs)
+        if loop.is_running():
+            return coroutine
+        return loop.run_until_complete(coroutine)
+    return run
+
+def run_in_thread(f, *args):
+    '''Run the blocking f(*args) in the loop's default executor.
+    @returns : a future of its result'''
+    require()
+    return asyncio.get_event_loop().run_in_executor(None, f, *args)
+
+_writer = list()
+
+def run_in_order(f, *args):
+    '''Run f(*args) in a single background thread so calls complete in the
+    order they were made (used for output and log).
+    @returns : a future of its result'''
+    require()
+    if not _writer:
+        import concurrent.futures
+        _writer.append(concurrent.futures.ThreadPoolExecutor(1))
+    return asyncio.get_event_loop().run_in_executor(_writer[0], f, *args)
+
+def output(*msgs):
+    '''lib.output without blocking the loop.'''
+    return run_in_order(lib.output, *msgs)
+
+def log(*msgs):
+    '''lib.log without blocking the loop.'''
+    return run_in_order(lib.log, *msgs)
+
+def output_many(records):
+    '''lib.output_many without blocking the loop.'''
+    return run_in_order(lib.output_many, records)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#Author: Tim Henderson
+#Email: tim.tadh@gmail.com
+#For licensing see the LICENSE file in the top level directory.
+
+'''Benchmarks for optutils based command line tools. Each benchmark module is
+runnable (eg. python -m optutils.benchmarks.startup) and outputs its results
+as JSON so runs can be compared.'''
+
+import os, json, time, tempfile, shutil
+
+def stats(times, number=1):
+    '''Summarize a list of timings (each of number calls) in seconds per
+    call.'''
+    times = sorted(t/number for t in times)
+    return {
+        'min': times[0],
+        'median': times[len(times)//2],
+        'mean': sum(times)/len(times),
+        'max': times[-1],
+        'repeat': len(times),
+        'number': number,
+    }
+
+def timed(f, repeat=5, number=1):
+    '''Time number calls of f, repeat times.
+    @returns : stats of the timings'''
+    times = list()
+    for _ in xrange(repeat):
+        start = time.time()
+        for _ in xrange(number):
+            f()
+        times.append(time.time() - start)
+    return stats(times, number)
+
+_leaves = (('int', 1), ('float', 1.5), ('str', 'value'), ('bool', True))
+
+def generate(depth=2, width=4, length=4, fanout=4):
+    '''
+    Generate a schema and a config which matches it.
+    @param depth : the number of levels of nested dicts
+    @param width : the number of nested dicts (or leaves at the bottom) in
+                   each dict
+    @param length : the length of the list of ints in each dict
+    @param fanout : the number of keys in the __undefinedkeys__ map in each
+                    dict
+    @returns : (schema, data)
+    '''
+    def proc(level):
+        schema = {
+            'list': ['int'],
+            'map': {'__undefinedkeys__': 'int'},
+        }
+        data = {
+            'list': range(length),
+            'map': dict(('m%d' % i, i) for i in xrange(fanout)),
+        }
+        for i in xrange(width):
+            k = 'k%d' % i
+            if level < depth:
+                schema[k], data[k] = proc(level + 1)
+            else:
+                schema[k], data[k] = _leaves[i % len(_leaves)]
+        return schema, data
+    return proc(1)
+
+class ConfigFiles(object):
+    '''A temporary directory of generated config files. Use as a context
+    manager, the directory is removed on exit.'''
+
+    def __init__(self, layers, **dims):
+        self.schema, self.data = generate(**dims)
+        self.dir = tempfile.mkdtemp(prefix='optutils-bench-')
+        self.paths = list()
+        for i in xrange(layers):
+            path = os.path.join(self.dir, 'layer-%d.json' % i)
+            with open(path, 'w') as f:
+                json.dump(self.data, f)
+            self.paths.append(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        shutil.rmtree(self.dir, True)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#Author: Tim Henderson
+#Email: tim.tadh@gmail.com
+#For licensing see the LICENSE file in the top level directory.
+
+'''Measures the time and peak memory of the phases of the config engine
+(skeleton, validate, cascade and expose) as the generated configs grow along
+one dimension at a time.'''
+
+import os, sys, gc, json, resource, collections
+
+import optutils
+from optutils import output, conf
+from optutils.benchmarks import timed, ConfigFiles
+
+base = {'depth': 2, 'width': 8, 'length': 16, 'fanout': 16, 'layers': 2}
+
+sweeps = {
+    'depth': [1, 2, 3, 4],
+    'width': [2, 8, 32],
+    'length': [16, 1024, 65536],
+    'fanout': [16, 1024, 16384],
+    'layers': [1, 4, 16],
+}
+
+def maxrss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss // 1024
+    return rss
+
+def measure(f, repeat):
+    '''Run f repeat times in a forked child. The peak is how much the child's
+    max RSS grew while running f, so each phase is measured from the same
+    starting point.
+    @returns : the timing stats with peak_rss_kb added
+    '''
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            gc.collect()
+            before = maxrss_kb()
+            results = list()
+            result = timed(lambda: results.append(f()), repeat)
+            result['peak_rss_kb'] = maxrss_kb() - before
+            os.write(w, json.dumps(result))
+        finally:
+            os._exit(0)
+    os.close(w)
+    chunks = list()
+    while True:
+        s = os.read(r, 65536)
+        if not s:
+            break
+        chunks.append(s)
+    os.close(r)
+    os.waitpid(pid, 0)
+    return json.loads(''.join(chunks))
+
+def walk(v):
+    '''touch every value of an exposed config'''
+    if isinstance(v, collections.Mapping):
+        for k in v:
+            walk(v[k])
+    elif isinstance(v, tuple):
+        for x in v:
+            walk(x)
+
+def phases(dims, repeat):
+    dims = dict(dims)
+    layers = dims.pop('layers')
+    with ConfigFiles(layers, **dims) as files:
+        c = conf.BaseConfig(files.schema, *files.paths)
+        data = conf.json_parser(files.paths[0])
+        conf_dicts = [{'ok': True, 'path': 'skeleton', 'conf': c._skeleton()}]
+        conf_dicts += [
+            {'ok': True, 'path': path, 'conf': data}
+            for path in files.paths
+        ]
+        return {
+            'skeleton': measure(c._skeleton, repeat),
+            'validate': measure(lambda: c._validate(data), repeat),
+            'cascade': measure(lambda: c._cascade(conf_dicts), repeat),
+            'expose_lazy': measure(
+                lambda: walk(conf.Section(c._d)), repeat),
+            'expose_slots': measure(
+                lambda: walk(c._compiled.expose(c._d)), repeat),
+        }
+
+@optutils.main(
+    'usage: python -m optutils.benchmarks.config [options]',
+    '''
+    Sweeps each dimension of the generated configs (depth, width, length,
+    fanout, layers) keeping the others at their base values and outputs the
+    time and peak memory of each phase of the config engine as JSON. Times are
+    in seconds.
+
+    Options
+        -h, help                      print this message
+        -r, repeat=<int>              times to repeat each measurement [3]
+        -d, dimension=<name>          only sweep this dimension
+    ''',
+    'hr:d:',
+    ['help', 'repeat=', 'dimension='],
+)
+def main(argv, util, parser):
+    opts, args = parser(argv)
+    repeat = 3
+    dimensions = sorted(sweeps)
+    for opt, arg in opts:
+        if opt in ('-h', '--help',):
+            util.usage()
+        elif opt in ('-r', '--repeat',):
+            repeat = util.parse_int(arg)
+        elif opt in ('-d', '--dimension',):
+            dimensions = [util.assert_in(arg, sweeps)]
+    results = list()
+    for dimension in dimensions:
+        for value in sweeps[dimension]:
+            dims = dict(base)
+            dims[dimension] = value
+            results.append({
+                'dimension': dimension,
+                'dims': dims,
+                'phases': phases(dims, repeat),
+            })
+    output(json.dumps({
+        'python': sys.version.split()[0],
+        'repeat': repeat,
+        'results': results,
+    }, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
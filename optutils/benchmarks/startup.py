@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#Author: Tim Henderson
+#Email: tim.tadh@gmail.com
+#For licensing see the LICENSE file in the top level directory.
+
+'''Measures how long an optutils tool takes to get to its command body.'''
+
+import os, sys, json, subprocess
+
+import optutils
+from optutils import output, conf
+from optutils.util import Util, parse_args, format_long
+from optutils.benchmarks import timed, ConfigFiles
+
+config_sizes = {
+    'small': {'depth': 1, 'width': 4, 'length': 4, 'fanout': 4},
+    'medium': {'depth': 3, 'width': 6, 'length': 16, 'fanout': 16},
+    'huge': {'depth': 4, 'width': 8, 'length': 64, 'fanout': 64},
+}
+
+def interpreter(code, repeat):
+    '''time starting a fresh interpreter which runs code'''
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(optutils.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (root, env.get('PYTHONPATH')) if p)
+    cmd = [sys.executable, '-c', code]
+    return timed(lambda: subprocess.check_call(cmd, env=env), repeat)
+
+def make_util(n):
+    '''a Util with n subcommands registered'''
+    util = Util('usage: bench <command>', format_long('''
+        Benchmark
+
+        Options
+            -h, help                      print this message
+    '''), optutils.log)
+    for i in xrange(n):
+        def command(argv, util, parser):
+            return parser(argv)
+        command.func_name = 'command%d' % i
+        util.command(
+            'usage: command%d [options]' % i,
+            '''
+            Options
+                -h, help                      print this message
+                -v, verbose                   be verbose
+                -o, output=<path>             where to put the output
+            ''',
+            'hvo:',
+            ['help', 'verbose', 'output='],
+        )(command)
+    return util
+
+def startup(repeat, commands):
+    argv = ['-v', '--output=out.txt', '-o', 'other.txt', 'a', 'b', 'c']
+    util = make_util(commands)
+    parser = parse_args('hvo:', ['help', 'verbose', 'output='], util)
+    results = {
+        'interpreter': interpreter('pass', repeat),
+        'import_optutils': interpreter('import optutils', repeat),
+        'import_optutils_conf': interpreter('import optutils.conf', repeat),
+        'make_commands': timed(lambda: make_util(commands), repeat),
+        'parse_args': timed(lambda: parser(argv), repeat, 1000),
+        'run_command': timed(
+            lambda: util.run_command(['command%d' % (commands//2)] + argv),
+            repeat, 1000),
+        'config': dict(),
+    }
+    for size, dims in config_sizes.iteritems():
+        with ConfigFiles(2, **dims) as files:
+            results['config'][size] = timed(
+                lambda: conf.BaseConfig(files.schema, *files.paths), repeat)
+    return results
+
+@optutils.main(
+    'usage: python -m optutils.benchmarks.startup [options]',
+    '''
+    Times interpreter start up, importing optutils, building a main with many
+    subcommands, parse_args, run_command and BaseConfig construction. Outputs
+    JSON. All times are in seconds.
+
+    Options
+        -h, help                      print this message
+        -r, repeat=<int>              times to repeat each measurement [5]
+        -c, commands=<int>            subcommands to register [80]
+    ''',
+    'hr:c:',
+    ['help', 'repeat=', 'commands='],
+)
+def main(argv, util, parser):
+    opts, args = parser(argv)
+    repeat = 5
+    commands = 80
+    for opt, arg in opts:
+        if opt in ('-h', '--help',):
+            util.usage()
+        elif opt in ('-r', '--repeat',):
+            repeat = util.parse_int(arg)
+        elif opt in ('-c', '--commands',):
+            commands = util.parse_int(arg)
+    results = {
+        'python': sys.version.split()[0],
+        'repeat': repeat,
+        'commands': commands,
+        'results': startup(repeat, commands),
+    }
+    output(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
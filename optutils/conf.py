@@ -5,8 +5,12 @@
 #Copyright (C) 2012 All Rights Reserved
 #For licensing see the LICENSE file in the top level directory.
 
-import sys, os, json, collections
+import sys, os, re, json, array, itertools, collections, hashlib, threading
+import contextlib
 import cStringIO as sio
+import cPickle
+
+from .lib import log
 
 UNDEFINED_KEYS = '__undefinedkeys__'
 
@@ -28,9 +32,105 @@ def encode(d):
         new[k] = v
     return new
 
+def decode_pairs(pairs):
+    '''An object_pairs_hook which builds the final dict directly, encoding
+    unicode keys and values (and the strings in list values) as utf-8. Lists
+    are encoded in place rather than copied.'''
+    new = dict()
+    for k,v in pairs:
+        if isinstance(v, list):
+            for i, x in enumerate(v):
+                if isinstance(x, unicode):
+                    v[i] = x.encode('utf-8')
+        elif isinstance(v, unicode):
+            v = v.encode('utf-8')
+        if isinstance(k, unicode): k = k.encode('utf-8')
+        new[k] = v
+    return new
+
 def json_parser(file_path):
     with open(file_path, 'rb') as f:
-        return json.load(f, object_hook=encode)
+        return json.load(f, object_pairs_hook=decode_pairs)
+
+_decoder = json.JSONDecoder(object_pairs_hook=decode_pairs)
+_whitespace = re.compile(r'[ \t\n\r]*')
+_number_chars = frozenset('0123456789.eE+-')
+
+def stream_json_parser(file_path, chunk_size=65536):
+    '''
+    Parse a JSON object like json_parser but read the file chunk_size bytes
+    at a time and decode the top level object one member at a time. Only the
+    text of the member being decoded is held in memory, never the whole file.
+    Use it as the parser for very large config files.
+    '''
+    with open(file_path, 'rb') as f:
+        state = {'buf': '', 'pos': 0, 'eof': False}
+
+        def more(size=chunk_size):
+            buf = state['buf'][state['pos']:]
+            s = f.read(size)
+            if not s:
+                state['eof'] = True
+            state['buf'] = buf + s
+            state['pos'] = 0
+
+        def skip():
+            while True:
+                m = _whitespace.match(state['buf'], state['pos'])
+                state['pos'] = m.end()
+                if state['pos'] < len(state['buf']) or state['eof']:
+                    return
+                more()
+
+        def peek():
+            skip()
+            if state['pos'] >= len(state['buf']):
+                raise ValueError('Unexpected end of file')
+            return state['buf'][state['pos']]
+
+        def expect(c):
+            if peek() != c:
+                raise ValueError(
+                    'Expecting %s: char %d' % (repr(c), f.tell()))
+            state['pos'] += 1
+
+        def value():
+            skip()
+            size = chunk_size
+            while True:
+                buf = state['buf']
+                try:
+                    v, end = _decoder.raw_decode(buf, state['pos'])
+                except ValueError:
+                    if state['eof']:
+                        raise
+                else:
+                    # a number at the end of the buffer may be cut short (eg.
+                    # "1." decodes as 1) so it must be followed by a delimiter
+                    if state['eof'] or (
+                          end < len(buf) and buf[end] not in _number_chars):
+                        state['pos'] = end
+                        return v
+                size *= 2
+                more(size)
+
+        pairs = list()
+        expect('{')
+        if peek() == '}':
+            state['pos'] += 1
+        else:
+            while True:
+                k = value()
+                expect(':')
+                pairs.append((k, value()))
+                if peek() == '}':
+                    state['pos'] += 1
+                    break
+                expect(',')
+        skip()
+        if state['pos'] < len(state['buf']):
+            raise ValueError('Extra data: char %d' % f.tell())
+        return decode_pairs(pairs)
 
 def strbool(*args):
     if not args:
@@ -52,20 +152,648 @@ default_types = {
     'float': float,
 }
 
+def schema_hash(schema):
+    '''A stable content hash (hex sha1) of a schema.'''
+    try:
+        s = json.dumps(schema, sort_keys=True)
+    except (TypeError, ValueError):
+        s = repr(schema)
+    return hashlib.sha1(s).hexdigest()
+
+class _TooManyErrors(Exception): pass
+
+_missing = object()
+
+_mapping_types = dict()
+
+def is_mapping(e):
+    '''isinstance(e, collections.Mapping) without the abc machinery on every
+    call (the answer is kept per type).'''
+    t = type(e)
+    r = _mapping_types.get(t)
+    if r is None:
+        r = _mapping_types[t] = issubclass(t, collections.Mapping)
+    return r
+
+def add_paths(index, path, e):
+    '''Index path -> e and the paths of every value below e (see
+    BaseConfig.get).'''
+    index[path] = e
+    if is_mapping(e):
+        for k in e:
+            add_paths(index, os.path.join(path, k), e[k])
+
+def remove_paths(index, path, e):
+    '''Remove path and the paths below it from index.'''
+    index.pop(path, None)
+    if is_mapping(e):
+        for k in e:
+            remove_paths(index, os.path.join(path, k), e[k])
+
+def split_path(path):
+    '''@returns : the keys of a path, eg. ['a', 'b', '0'] for /a/b/0'''
+    path = path.strip('/')
+    if not path:
+        return list()
+    return path.split('/')
+
+def resolve(e, keys):
+    '''
+    Follow keys (dict keys or list indices) down from the exposed value e.
+    @returns : the value or _missing if there is nothing there
+    '''
+    for k in keys:
+        try:
+            if is_mapping(e):
+                e = e[k]
+            else:
+                e = e[int(k)]
+        except (KeyError, IndexError, ValueError, TypeError):
+            return _missing
+    return e
+
+def update_paths(d):
+    '''The paths an update replaces: its non dict values and empty dicts.'''
+    paths = list()
+    def proc(d, path):
+        if not d:
+            paths.append(path)
+        for k, v in d.iteritems():
+            p = os.path.join(path, k)
+            if isinstance(v, dict):
+                proc(v, p)
+            else:
+                paths.append(p)
+    proc(d, '/')
+    return paths
+
+def join_path(path):
+    '''
+    Validation passes the path of a value as a chain of (parent, key) tuples
+    ending in '/' so the path string is only built for values with errors.
+    @returns : the path string, eg. /a/b/0
+    '''
+    keys = list()
+    while isinstance(path, tuple):
+        path, k = path
+        keys.append(k if isinstance(k, basestring) else str(k))
+    keys.reverse()
+    return os.path.join(path, *keys)
+
+class LeafNode(object):
+    '''A compiled schema leaf, eg. "int". The type function is looked up
+    once at compile time rather than on every value.'''
+
+    def __init__(self, t, types):
+        self.t = t
+        self.type = types.get(t) if isinstance(t, basestring) else None
+
+    def gettype(self):
+        if self.type is None:
+            raise Exception, 'Type %s unsupported' % self.t
+        return self.type
+
+    def validate(self, v, path, add_error):
+        if self.type is None:
+            add_error(path, 'Type %s unsupported' % self.t)
+            return
+        try:
+            self.type(v)
+        except Exception, e:
+            add_error(path, ', '.join(e.args))
+
+    def cascade(self, a, v):
+        return self.gettype()(v)
+
+    def merge(self, a, v):
+        v = self.gettype()(v)
+        if type(a) is type(v) and a == v:
+            return a
+        return v
+
+    def skeleton(self):
+        return self.gettype()()
+
+    def expose(self, v, a=None, e=None):
+        return v
+
+class ListNode(object):
+    '''A compiled list schema, eg. ["int"].'''
+
+    def __init__(self, t, types, typed_lists=False):
+        self.t = t
+        self.item = compile_node(t[0], types, typed_lists) if t else None
+
+    def validate(self, v, path, add_error):
+        if len(self.t) != 1:
+            msg = "A list schema should have only one item. Got " + str(self.t)
+            add_error(path, msg)
+        if not isinstance(v, list):
+            msg = ("Expected a list got %s" % type(v))
+            add_error(path, msg)
+            return
+        if self.item is None:
+            return
+        item = self.item
+        for i, x in enumerate(v):
+            item.validate(x, (path, i), add_error)
+
+    def cascade(self, a, v):
+        item = self.item
+        return [item.cascade(None, x) for x in v]
+
+    def merge(self, a, v):
+        item = self.item
+        v = [item.merge(None, x) for x in v]
+        if a == v:
+            return a
+        return v
+
+    def skeleton(self):
+        return list()
+
+    def expose(self, v, a=None, e=None):
+        if v is a:
+            return e
+        item = self.item
+        return tuple(item.expose(x) for x in v)
+
+_typecodes = {
+    'int': 'l',
+    'float': 'd',
+    'bool': 'b',
+}
+
+# the item types array.array always packs for each typecode (a python 2 int
+# is a C long)
+_packable_types = {
+    'l': frozenset([int, bool]),
+    'd': frozenset([int, float, bool]),
+    'b': frozenset([bool]),
+}
+
+class TypedList(collections.Sequence):
+    '''A read only list of ints, floats or bools kept in an array.array. It
+    indexes, iterates and compares like a tuple while using a machine word
+    per item instead of a boxed object.'''
+
+    __slots__ = ('_a', '_bools')
+
+    def __init__(self, a, bools=False):
+        '''
+        @param a : the array.array of the values
+        @param bools : the values are bools (kept in an array of type 'b')
+        '''
+        self._a = a
+        self._bools = bools
+
+    @property
+    def typecode(self):
+        '''The array typecode of the values, or '?' for bools.'''
+        return '?' if self._bools else self._a.typecode
+
+    @property
+    def itemsize(self):
+        return self._a.itemsize
+
+    def tostring(self):
+        '''The machine values as a string (see array.tostring).'''
+        return self._a.tostring()
+
+    def __len__(self):
+        return len(self._a)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return TypedList(self._a[i], self._bools)
+        if self._bools:
+            return bool(self._a[i])
+        return self._a[i]
+
+    def __iter__(self):
+        if self._bools:
+            return itertools.imap(bool, self._a)
+        return iter(self._a)
+
+    def __eq__(self, other):
+        if isinstance(other, TypedList):
+            return self._a == other._a
+        elif isinstance(other, tuple):
+            return tuple(self) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+    def __reduce__(self):
+        return (TypedList, (self._a, self._bools))
+
+class TypedListNode(ListNode):
+    '''A compiled list of int, float or bool (with the default type functions)
+    kept as a TypedList. A list is converted in one pass by array.array; only
+    when that fails is it converted (and validated) item by item so the
+    errors and the results are the same as for a ListNode. Validation only
+    looks at the types of the items so a list is packed once, by cascade.'''
+
+    def __init__(self, t, types):
+        super(TypedListNode, self).__init__(t, types)
+        self.typecode = _typecodes[t[0]]
+
+    def packable(self, v):
+        '''@returns : True if pack(v) can not fail'''
+        return set(itertools.imap(type, v)) <= _packable_types[self.typecode]
+
+    def pack(self, v):
+        '''@returns : v as an array or None if it can't be packed as is'''
+        if self.typecode == 'b' and not self.packable(v):
+            return None
+        try:
+            return array.array(self.typecode, v)
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    def validate(self, v, path, add_error):
+        if isinstance(v, list) and self.packable(v):
+            return
+        super(TypedListNode, self).validate(v, path, add_error)
+
+    def cascade(self, a, v):
+        packed = self.pack(v)
+        if packed is None:
+            v = super(TypedListNode, self).cascade(None, v)
+            packed = self.pack(v)
+            if packed is None:
+                # eg. ints which do not fit in a C long
+                return v
+        return TypedList(packed, self.typecode == 'b')
+
+    def merge(self, a, v):
+        v = self.cascade(None, v)
+        if type(a) is type(v) and a == v:
+            return a
+        return v
+
+    def expose(self, v, a=None, e=None):
+        if isinstance(v, TypedList):
+            return v
+        return super(TypedListNode, self).expose(v, a, e)
+
+class DictNode(object):
+    '''A compiled dict schema with a fixed set of keys.'''
+
+    def __init__(self, t, types, typed_lists=False):
+        self.t = t
+        self.keys = set(t.keys())
+        self.children = dict(
+            (k, compile_node(v, types, typed_lists))
+            for k, v in t.iteritems()
+        )
+
+    def check(self, v, path, add_error):
+        if not isinstance(v, dict):
+            msg = (
+              "Expected a dict got %s, '%s'\n %s %s" %
+              (type(v), str(v), str(self.t), str(v))
+            )
+            add_error(path, msg)
+            return False
+        return True
+
+    def validate(self, v, path, add_error):
+        if not self.check(v, path, add_error):
+            return
+        children = self.children
+        for k in v:
+            if k not in children:
+                msg = (
+                  "Unexpected name, '%s'. The name must be in %s"
+                ) % (k, str(list(self.keys)))
+                add_error(path, msg)
+        for k, x in v.iteritems():
+            if k in children:
+                children[k].validate(x, (path, k), add_error)
+
+    def child(self, k):
+        return self.children[k]
+
+    def cascade(self, a, v):
+        if a is None:
+            a = dict()
+        children = self.children
+        for k, x in v.iteritems():
+            a[k] = children[k].cascade(a.get(k), x)
+        return a
+
+    def merge(self, a, v):
+        '''Like cascade but a is left untouched. Only the dicts on the paths
+        in v which actually change are copied, everything else (and a itself
+        if nothing changed) is shared with a.'''
+        return self.merge_children(a, v, self.children.__getitem__)
+
+    def merge_children(self, a, v, child):
+        if a is None:
+            a = dict()
+        new = None
+        for k, x in v.iteritems():
+            old = a.get(k)
+            m = child(k).merge(old, x)
+            if m is not old:
+                if new is None:
+                    new = dict(a)
+                new[k] = m
+        if new is None:
+            return a
+        return new
+
+    def skeleton(self):
+        return dict(
+            (k, c.skeleton())
+            for k, c in self.children.iteritems()
+        )
+
+    def expose(self, v, a=None, e=None):
+        '''
+        Eagerly expose v as an instance of the generated section class for this
+        shape. Falls back to a Section if the keys can't be slots or some are
+        missing.
+        @param v : the cascaded value
+        @param a : the previous version of v (or None)
+        @param e : what a was exposed as. Children of v which are the same
+                   object as in a are not exposed again.
+        '''
+        if v is a:
+            return e
+        cls = section_class(self.keys)
+        if cls is None or len(v) != len(self.children):
+            return Section(v)
+        if not isinstance(e, cls):
+            a = None
+        obj = object.__new__(cls)
+        for k, c in self.children.iteritems():
+            if a is None:
+                x = c.expose(v[k])
+            else:
+                x = c.expose(v[k], a.get(k), getattr(e, k))
+            object.__setattr__(obj, k, x)
+        return obj
+
+class MapNode(DictNode):
+    '''A compiled dict schema using __undefinedkeys__. Every key shares the
+    same value schema.'''
+
+    def __init__(self, t, types, typed_lists=False):
+        self.t = t
+        self.keys = set(t.keys())
+        self.item = compile_node(t[UNDEFINED_KEYS], types, typed_lists)
+
+    def validate(self, v, path, add_error):
+        if not self.check(v, path, add_error):
+            return
+        if len(self.keys) != 1:
+            msg = (
+                "A dict schema with __undefinedkeys__ should have "
+                "only one item. Got " + str(self.t)
+            )
+            add_error(path, msg)
+            return
+        item = self.item
+        for k, x in v.iteritems():
+            item.validate(x, (path, k), add_error)
+
+    def child(self, k):
+        return self.item
+
+    def cascade(self, a, v):
+        if a is None:
+            a = dict()
+        item = self.item
+        for k, x in v.iteritems():
+            a[k] = item.cascade(a.get(k), x)
+        return a
+
+    def merge(self, a, v):
+        return self.merge_children(a, v, self.child)
+
+    def skeleton(self):
+        return dict()
+
+    def expose(self, v, a=None, e=None):
+        '''Expose v as a Section (keeping the mapping behavior) with all of
+        its values exposed up front.'''
+        if v is a:
+            return e
+        item = self.item
+        old = e._c if isinstance(e, Section) else dict()
+        c = dict()
+        for k, x in v.iteritems():
+            p = old.get(k)
+            if p is None:
+                c[k] = (x, item.expose(x))
+            else:
+                c[k] = (x, item.expose(x, p[0], p[1]))
+        return Section(v, c)
+
+def compile_node(t, types, typed_lists=False):
+    if isinstance(t, dict):
+        if UNDEFINED_KEYS in t:
+            return MapNode(t, types, typed_lists)
+        return DictNode(t, types, typed_lists)
+    elif isinstance(t, list):
+        if (typed_lists and len(t) == 1 and isinstance(t[0], basestring) and
+              t[0] in _typecodes and types.get(t[0]) is default_types[t[0]]):
+            return TypedListNode(t, types)
+        return ListNode(t, types, typed_lists)
+    return LeafNode(t, types)
+
+_compiled = collections.OrderedDict()
+_compiled_lock = threading.Lock()
+_max_compiled = 64
+
+def types_signature(types):
+    '''@returns : a hashable signature of a types mapping, by the names and
+    the function_signature of the type functions, or None if one of them
+    can't be identified'''
+    sigs = list()
+    for name, f in types.iteritems():
+        sig = function_signature(f)
+        if sig is None:
+            return None
+        sigs.append((name, sig))
+    return frozenset(sigs)
+
+def compile_schema(schema, types=default_types, typed_lists=False):
+    '''Compile a schema into a tree of nodes which validate, cascade and
+    produce skeletons without re-reading the schema. Compiled schemas are
+    cached on the content hash of the schema and the signature of the types
+    mapping so configs built against the same schema share one tree. The
+    cache keeps the most recently used trees. When a type function can't be
+    identified (see function_signature) the schema is compiled uncached.
+
+    :param schema: the schema
+    :param types=default_types: a dictionary (string->type-func)
+    :param typed_lists=False: compile lists of int, float and bool to
+                              TypedListNodes (see BaseConfig)
+    :returns: the root node, its hash is available as node.hash
+    '''
+    h = schema_hash(schema)
+    sig = types_signature(types)
+    if sig is None:
+        node = compile_node(schema, types, typed_lists)
+        node.hash = h
+        return node
+    key = (h, sig, typed_lists)
+    with _compiled_lock:
+        node = _compiled.pop(key, None)
+        if node is not None:
+            _compiled[key] = node
+            return node
+    node = compile_node(schema, types, typed_lists)
+    node.hash = h
+    with _compiled_lock:
+        _compiled[key] = node
+        while len(_compiled) > _max_compiled:
+            _compiled.popitem(last=False)
+    return node
+
+def stat_signature(path):
+    '''The (mtime, size, inode) of path or None if it does not exist.'''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+_builtin_function = type(len)
+
+def code_signature(code):
+    '''A hash of a code object which changes when its code does.'''
+    consts = tuple(
+        code_signature(c) if isinstance(c, type(code)) else c
+        for c in code.co_consts
+    )
+    return hashlib.sha1(repr(
+        (code.co_code, consts, code.co_names, code.co_varnames)
+    )).hexdigest()
+
+def function_signature(f):
+    '''
+    A signature of a function which is stable between processes and changes
+    with its implementation. For python functions it covers the code, the
+    defaults and the values of the closure, not just the name (every lambda
+    is called <lambda>).
+    @returns : the signature or None if f can't be identified (eg. a
+               callable object or a closure over a value which can't be
+               pickled)
+    '''
+    f = getattr(f, 'im_func', f)
+    name = (
+        getattr(f, '__module__', None),
+        getattr(f, '__name__', type(f).__name__),
+    )
+    code = getattr(f, 'func_code', None)
+    if code is None:
+        if isinstance(f, (type, _builtin_function)):
+            return name
+        return None
+    try:
+        values = cPickle.dumps((
+            f.func_defaults,
+            [cell.cell_contents for cell in f.func_closure or ()],
+        ), 2)
+    except Exception:
+        return None
+    return name + (code_signature(code), hashlib.sha1(values).hexdigest())
+
+def combine(ds):
+    '''Combine a sequence of validated updates into one. Later updates win
+    and dicts are combined key by key. The updates are not modified.'''
+    def proc(a, d):
+        for k, v in d.iteritems():
+            if isinstance(v, dict):
+                if not isinstance(a.get(k), dict):
+                    a[k] = dict()
+                proc(a[k], v)
+            else:
+                a[k] = v
+        return a
+    if len(ds) == 1:
+        return ds[0]
+    combined = dict()
+    for d in ds:
+        proc(combined, d)
+    return combined
+
+def reconcile(a, b, path='/'):
+    '''
+    Compare b, a new version of the cascaded config a. Every sub-tree of b
+    which is equal to the one in a is replaced by a's so the unchanged parts
+    of the config keep their identity.
+    @returns : (b, a list of the paths (eg. /a/b/0) at which a and b differ)
+    '''
+    changed = list()
+    def proc(a, b, path):
+        if a is b:
+            return a
+        if isinstance(a, dict) and isinstance(b, dict):
+            same = len(a) == len(b)
+            new = dict()
+            for k, v in b.iteritems():
+                p = os.path.join(path, k)
+                if k not in a:
+                    changed.append(p)
+                    new[k] = v
+                    same = False
+                else:
+                    new[k] = proc(a[k], v, p)
+                    same = same and new[k] is a[k]
+            for k in a:
+                if k not in b:
+                    changed.append(os.path.join(path, k))
+            if same:
+                return a
+            return new
+        elif type(a) is type(b) and a == b:
+            return a
+        changed.append(path)
+        return b
+    b = proc(a, b, path)
+    return b, changed
+
+def expose(v):
+    '''The read only view of a cascaded value. Dicts become Sections and
+    lists become tuples.'''
+    if isinstance(v, dict):
+        return Section(v)
+    elif isinstance(v, list):
+        return tuple(expose(x) for x in v)
+    return v
+
 class Section(collections.Mapping):
+    '''A read only view of a cascaded dict. Child sections and tuples are
+    made on first access and kept.'''
 
-    def __init__(self, d):
+    def __init__(self, d, cache=None):
         object.__setattr__(self, '_d', d)
+        object.__setattr__(self, '_c', dict() if cache is None else cache)
 
     def __repr__(self):
-        return str(self._d)
+        return str(dict((k, expose(v)) for k, v in self._d.iteritems()))
 
     def __getattribute__(self, name):
-        if name == '_d':
-            return super(Section, self).__getattribute__(name)
+        if name == '_d' or name == '_c':
+            return object.__getattribute__(self, name)
         if name in self._d:
-            return self._d[name]
-        return super(Section, self).__getattribute__(name)
+            return self[name]
+        return object.__getattribute__(self, name)
 
     def __setattr__(self, name, value):
         if name in self._d:
@@ -82,7 +810,83 @@ class Section(collections.Mapping):
         return len(self._d)
 
     def __getitem__(self, name):
-        return self._d[name]
+        c = self._c
+        if name in c:
+            return c[name][1]
+        v = self._d[name]
+        if isinstance(v, dict) or isinstance(v, list):
+            e = expose(v)
+            c[name] = (v, e)
+            return e
+        return v
+
+class FixedSection(collections.Mapping):
+    '''The base of the generated section classes (see section_class). The
+    keys are slots so reading one is a plain attribute load.'''
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return str(dict((k, getattr(self, k)) for k in self.__slots__))
+
+    def __setattr__(self, name, value):
+        raise TypeError, "Section does not support item assignment"
+
+    def __contains__(self, name):
+        return name in self.__keys__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __getitem__(self, name):
+        if name not in self.__keys__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+_identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+_section_classes = dict()
+
+def section_class(keys):
+    '''
+    The immutable, slotted section class for a dict schema with the given
+    keys. Classes are generated once per shape.
+    @returns : the class or None if some key can not be a slot
+    '''
+    keys = tuple(sorted(keys))
+    if keys in _section_classes:
+        return _section_classes[keys]
+    cls = None
+    if all(
+          isinstance(k, str) and _identifier.match(k) and not k.startswith('__')
+          for k in keys):
+        cls = type('FixedSection', (FixedSection,), {
+            '__module__': __name__,
+            '__slots__': keys,
+            '__keys__': frozenset(keys),
+        })
+    _section_classes[keys] = cls
+    return cls
+
+def derive_section(section, d):
+    '''
+    Make the Section for d, a new version of the dict section views. The
+    children section already made are kept when their value is the same object
+    in d (as it is for the parts of a config untouched by a merge) so only the
+    changed sub-trees are made again.
+    '''
+    c = dict()
+    for k, (old, e) in section._c.iteritems():
+        if k not in d:
+            continue
+        new = d[k]
+        if new is old:
+            c[k] = (old, e)
+        elif isinstance(e, Section) and isinstance(new, dict):
+            c[k] = (new, derive_section(e, new))
+    return Section(d, c)
 
 class BaseConfig(object):
 
@@ -105,66 +909,218 @@ class BaseConfig(object):
                                    this speaks JSON. Using this you can
                                    override that with another language. Just
                                    make sure it outputs JSON compatible
-                                   dictionaries.
+                                   dictionaries. stream_json_parser reads
+                                   very large JSON files incrementally.
+        :param cache_dir=None: a directory in which to keep the validated and
+                               cascaded result of reading paths. The cached
+                               result is used as long as none of the paths
+                               changed (mtime, size, inode) and the schema,
+                               types and parser are the same. Values produced
+                               by the types functions must be picklable.
+        :param reloadable=False: keep each path's contents so reload() and
+                                 watch() can pick up changes to the files. The
+                                 cache_dir is not used for reloadable configs.
+        :param on_reload=None: a function (config, changed) called after a
+                               reload changed the config. changed is a list of
+                               paths like /a/b.
+        :param workers=1: the number of threads used to read, parse and
+                          validate the paths. With more than one the paths
+                          are loaded concurrently (which helps on slow or
+                          network file systems) and then cascaded in order.
+                          Errors are still reported in path order.
+        :param typed_lists=False: keep lists of int, float and bool (with the
+                                  default type functions) as TypedLists,
+                                  compact read only sequences backed by an
+                                  array.array, converted and validated in
+                                  one pass instead of item by item.
+        :param max_errors=None: stop validating a file (or update) once this
+                                many errors were found in it instead of
+                                reporting every error.
+        :param exposure='lazy': how the config is exposed. 'lazy' makes child
+                                sections on first access. 'slots' exposes
+                                every dict with a fixed set of keys as an
+                                instance of a generated class with those keys
+                                as slots so reads are plain attribute loads.
+                                __undefinedkeys__ dicts stay mappings.
         '''
         self = super(BaseConfig, cls).__new__(cls)
-        self._d = dict()
+        # the cascaded dict and its exposed view are published together as
+        # one attribute so readers never see one without the other
+        self._state = (dict(), None)
         self.schema = schema
         self.paths = paths
         self.types = kwargs.get('types', default_types)
         self.parser = kwargs.get('parser', json_parser)
+        self._typed_lists = kwargs.get('typed_lists', False)
+        self._compiled = compile_schema(schema, self.types, self._typed_lists)
         local_updates = kwargs.get('local_updates', None)
+        cache_dir = kwargs.get('cache_dir', None)
+        reloadable = kwargs.get('reloadable', False)
+        self._on_reload = kwargs.get('on_reload', None)
+        self._workers = kwargs.get('workers', 1)
+        self._max_errors = kwargs.get('max_errors', None)
+        self._exposure = kwargs.get('exposure', 'lazy')
+        if self._exposure not in ('lazy', 'slots'):
+            raise ConfigError('unknown exposure %s' % self._exposure)
+        self._lock = threading.RLock()
+        self._layers = None
+        self._local = list()
+        self._updates = dict()
+        self._watcher = None
+        self._frozen = None
+        self._index = None
 
-        conf_dicts = self.__process_paths(paths)
-        if local_updates is not None:
-            self.__process_dict(conf_dicts, 'local_updates', local_updates, None)
-
-        self._d = self._cascade(conf_dicts)
-
-        self.errors = list()
-        for d in conf_dicts:
-            if d['err'] != None:
-                if not isinstance(d['err'], list):
-                    self.errors.append(d['path'] + ' - ' + d['err'])
-                    continue
-                for err in d['err']:
-                    self.errors.append(d['path'] + ' - ' + err)
+        cached = None
+        cache_path = None
+        if cache_dir is not None and not reloadable:
+            cache_path = self.__cache_path(cache_dir)
+        if cache_path is not None:
+            sig = [stat_signature(path) for path in paths]
+            cached = self.__load_cache(cache_path, sig)
 
+        if cached is not None:
+            d, self.errors, ok = cached
+            self._state = (d, None)
+        else:
+            conf_dicts = self.__process_paths(paths)
+            if reloadable:
+                self._layers = conf_dicts
+                self._state = (self.__recascade(0), None)
+            else:
+                self._state = (self._cascade(conf_dicts), None)
+            self.errors = self.__collect_errors(conf_dicts)
+            ok = any(d['ok'] for d in conf_dicts if d['path'] is not 'skeleton')
+            if cache_path is not None:
+                self.__store_cache(cache_path, sig, (self._d, self.errors, ok))
 
-        no_good_conf = all(
-            d['ok'] == False
-            for d in conf_dicts
-            if d['path'] is not 'skeleton'
-        )
+        if local_updates is not None:
+            self.__process_dict(self._local, 'local_updates', local_updates, None)
+            if self._local[0]['ok']:
+                if self._layers is not None:
+                    self._state = (
+                        self._compiled.merge(self._d, local_updates), None)
+                    self._updates = local_updates
+                else:
+                    self._compiled.cascade(self._d, local_updates)
+            self.errors += self.__collect_errors(self._local)
+            ok = ok or self._local[0]['ok']
 
-        if no_good_conf:
+        if not ok:
             raise ConfigError('no good configuration found', *self.errors)
 
         return self
 
     def __init__(self, schema, *paths, **kwargs):
-        self._expose_dict()
+        self._expose_dict(self._d)
 
     def __process_paths(self, paths):
         conf_dicts = [
           {'ok':True, 'path':'skeleton', 'conf':self._skeleton(), 'err':None},
         ]
-        for file_path in paths:
-            if os.path.exists(file_path):
-                d = None
-                err = None
-                try:
-                    d = self.parser(file_path)
-                except Exception, e:
-                    err = 'file did not parse. ' + ', '.join(e.args)
-                self.__process_dict(conf_dicts, file_path, d, err)
-            else:
-                self.__process_dict(
-                    conf_dicts, file_path, None,
-                    'File %s did not exist' % file_path
-                )
+        if self._workers > 1 and len(paths) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self._workers, len(paths)))
+            try:
+                conf_dicts.extend(pool.map(self.__load_path, paths))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for file_path in paths:
+                self.__process_path(conf_dicts, file_path)
         return conf_dicts
 
+    def __load_path(self, file_path):
+        conf_dicts = list()
+        self.__process_path(conf_dicts, file_path)
+        return conf_dicts[0]
+
+    def __process_path(self, conf_dicts, file_path):
+        stat = stat_signature(file_path)
+        if stat is not None:
+            d = None
+            err = None
+            try:
+                d = self.parser(file_path)
+            except Exception, e:
+                err = 'file did not parse. ' + ', '.join(e.args)
+            self.__process_dict(conf_dicts, file_path, d, err)
+        else:
+            self.__process_dict(
+                conf_dicts, file_path, None,
+                'File %s did not exist' % file_path
+            )
+        conf_dicts[-1]['stat'] = stat
+
+    def __recascade(self, start):
+        '''cascade the layers from start down, re-using the cascaded result of
+        the layers above start.'''
+        root = self._compiled
+        d = self._layers[start-1]['cascaded'] if start > 0 else None
+        for layer in self._layers[start:]:
+            if layer['ok']:
+                d = root.merge(d, layer['conf'])
+            layer['cascaded'] = d
+        return d
+
+    def __collect_errors(self, conf_dicts):
+        errors = list()
+        for d in conf_dicts:
+            if d['err'] != None:
+                if not isinstance(d['err'], list):
+                    errors.append(d['path'] + ' - ' + d['err'])
+                    continue
+                for err in d['err']:
+                    errors.append(d['path'] + ' - ' + err)
+        return errors
+
+    def __cache_path(self, cache_dir):
+        '''@returns : the path of the cache entry or None if the config can't
+        be cached because a types or parser function can't be identified'''
+        functions = sorted(self.types.items()) + [('parser', self.parser)]
+        signatures = list()
+        for name, f in functions:
+            signature = function_signature(f)
+            if signature is None:
+                log('not caching the config: the function for %s (%r) can not '
+                    'be identified' % (name, f))
+                return None
+            signatures.append((name, signature))
+        key = (
+            self._compiled.hash,
+            signatures,
+            self._max_errors,
+            self._typed_lists,
+            [os.path.abspath(path) for path in self.paths],
+        )
+        name = hashlib.sha1(repr(key)).hexdigest() + '.conf-cache'
+        return os.path.join(os.path.abspath(os.path.expanduser(cache_dir)), name)
+
+    def __load_cache(self, cache_path, sig):
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_sig, result = cPickle.load(f)
+        except Exception:
+            return None
+        if cached_sig != sig:
+            return None
+        return result
+
+    def __store_cache(self, cache_path, sig, result):
+        '''Write the cache entry. The cache is best effort: if it can't be
+        written the config is still good.'''
+        tmp = '%s.%d.tmp' % (cache_path, os.getpid())
+        try:
+            cache_dir = os.path.dirname(cache_path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(tmp, 'wb') as f:
+                cPickle.dump((sig, result), f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, cache_path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
     def __process_dict(self, conf_dicts, file_path, d, err):
           if err == None:
               err = self._validate(d)
@@ -184,12 +1140,16 @@ class BaseConfig(object):
               })
 
     def __getattribute__(self, name):
-        if name == '_d' or name == '_exposed':
+        if name == '_state':
             return object.__getattribute__(self, name)
-
-        if name in self._d:
-            return self._exposed.__getattribute__(name)
-        return super(BaseConfig, self).__getattribute__(name)
+        d, exposed = object.__getattribute__(self, '_state')
+        if name == '_d':
+            return d
+        elif name == '_exposed':
+            return exposed
+        if name in d:
+            return getattr(exposed, name)
+        return object.__getattribute__(self, name)
 
     def __getitem__(self, name):
         return self._exposed.__getattribute__(name)
@@ -206,63 +1166,290 @@ class BaseConfig(object):
     def update(self, d):
         '''
         A localized configuration options specific to this run. Cascade them
-        down onto the current configurator and re-expose.
+        down onto the current configurator and re-expose. Only the keys in d
+        are merged, the rest of the config is shared with the previous
+        version.
         @param d : the dict of new configuration options
         '''
-        err = self._validate(d)
-        if err:
-            raise ConfigError('update did not validate', *err)
+        self.update_many([d])
 
-        self._d = self._cascade([
-          {'ok':True, 'path':'current', 'conf':self._d},
-          {'ok':True, 'path':'new_mixin', 'conf':d}
-        ])
-        self._expose_dict()
+    def update_many(self, ds):
+        '''
+        Apply several updates at once. Every update is validated before any
+        is applied, then they are combined (later updates win), merged in one
+        pass and the config is re-exposed once.
+        @param ds : a sequence of dicts of new configuration options
+        '''
+        self.__assert_not_frozen()
+        errors = list()
+        for d in ds:
+            err = self._validate(d)
+            if err:
+                errors.extend(err)
+        if errors:
+            raise ConfigError('update did not validate', *errors)
 
-    ## ## private methods ## ##
-    def _expose_dict(self):
+        d = combine(ds)
+        with self._lock:
+            new = self._compiled.merge(self._d, d)
+            if self._layers is not None:
+                # reload re-applies the updates as one combined delta
+                self._updates = combine([self._updates, d])
+            if new is not self._d:
+                self._expose_dict(new, update_paths(d))
 
-        def proc(v):
-            if isinstance(v, dict):
-                return procdict(v)
-            elif isinstance(v, list):
-                return proclist(v)
-            else:
-                return v
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Collect updates and apply them with update_many when the block exits
+        without an exception.
+
+        ex.
+            with config.transaction() as updates:
+                updates.append({'a': 1})
+                updates.append({'b': {'c': 2}})
+        '''
+        updates = list()
+        yield updates
+        self.update_many(updates)
+
+    def write_snapshot(self, path):
+        '''
+        Compile the cascaded config into a snapshot file which other processes
+        can load without parsing (see optutils.snapshot).
+        @param path : where to write the snapshot
+        '''
+        from . import snapshot
+        snapshot.write(self, path)
+
+    def get(self, path, default=None):
+        '''
+        Look up a value by its path, eg. /a/b or /l/0 (the paths of the
+        validation errors). The first lookup indexes the path of every dict
+        and dict value of the config, which exposes all of it (including
+        every section of large __undefinedkeys__ dicts). Afterwards a path is
+        one dict lookup, plus one step per path element after the first list
+        on the path. Updates and reloads keep the index current.
+
+        A frozen config is not indexed, that would copy the shared map into
+        every worker which calls get. The path is looked up one element at a
+        time in the map instead.
+        @param path : the path
+        @param default : returned if there is nothing at path
+        @returns : the exposed value at path
+        '''
+        v = self.__lookup('/' + path.strip('/'))
+        if v is _missing:
+            return default
+        return v
+
+    def __lookup(self, path):
+        if self._frozen is not None:
+            return resolve(self._exposed, split_path(path))
+        index = self.__path_index()
+        v = index.get(path, _missing)
+        if v is not _missing:
+            return v
+        tail = list()
+        head = path
+        while v is _missing and head != '/':
+            head, k = os.path.split(head)
+            tail.append(k)
+            v = index.get(head, _missing)
+        if v is _missing:
+            return v
+        tail.reverse()
+        return resolve(v, tail)
+
+    def iterpaths(self, prefix='/'):
+        '''
+        Iterate over the paths of the dicts and dict values (see get) in the
+        subtree at prefix, including prefix itself. Lists are not descended
+        into.
+        @param prefix : the path of the subtree
+        @returns iterator : of (path, exposed value) in sorted order
+        '''
+        prefix = '/' + prefix.strip('/')
+        v = self.__lookup(prefix)
+        if v is _missing:
+            return
+        stack = [(prefix, v)]
+        while stack:
+            path, v = stack.pop()
+            yield path, v
+            if is_mapping(v):
+                stack.extend(
+                    (os.path.join(path, k), v[k])
+                    for k in sorted(v, reverse=True)
+                )
 
-        def proclist(l):
-            return tuple([
-                proc(v)
-                for v in l
-            ])
+    def freeze(self):
+        '''
+        Move the cascaded config into an anonymous shared memory map (in the
+        snapshot format, see optutils.snapshot) and read it from there from
+        now on. The python objects of the config are released. Freeze before
+        forking workers: the map is shared by every worker and reading the
+        config does not touch (and so copy) any page of it, a worker only
+        keeps the sections it reads. A frozen config can not be updated or
+        reloaded.
+        '''
+        from . import snapshot
+        with self._lock:
+            if self._frozen is not None:
+                return
+            self.unwatch()
+            self._frozen, root = snapshot.share(self._d, self._compiled.hash)
+            self._state = (root, root)
+            self._index = None
+            self._layers = None
+            self._local = list()
+            self._updates = dict()
 
-        def procdict(d):
-            a = dict(
-                (k, proc(v))
-                for k,v in d.iteritems()
+    def reload(self):
+        '''
+        Re-read the paths which changed (mtime, size or inode) since they were
+        last read and re-cascade from the first changed layer down. The other
+        paths are not re-read. Local updates are re-applied on top. Readers see
+        the new configuration all at once. A path which no longer parses or
+        validates keeps its last good contents and its errors are reported in
+        self.errors.
+        @returns : a list of the changed keys as paths (eg. /a/b)
+        '''
+        self.__assert_not_frozen()
+        if self._layers is None:
+            raise ConfigError('config was not constructed with reloadable=True')
+        with self._lock:
+            start = None
+            for i in xrange(1, len(self._layers)):
+                layer = self._layers[i]
+                if stat_signature(layer['path']) == layer['stat']:
+                    continue
+                new = list()
+                self.__process_path(new, layer['path'])
+                new = new[0]
+                if not new['ok'] and layer['ok']:
+                    new['ok'] = True
+                    new['conf'] = layer['conf']
+                # still right unless a layer above changed, and then it is
+                # re-cascaded from start anyway
+                new['cascaded'] = layer['cascaded']
+                self._layers[i] = new
+                if start is None and new['ok'] and new['conf'] is not layer['conf']:
+                    start = i
+            self.errors = (
+                self.__collect_errors(self._layers) +
+                self.__collect_errors(self._local)
             )
-            return Section(a)
+            if start is None:
+                return list()
+            d = self.__recascade(start)
+            if self._updates:
+                d = self._compiled.merge(d, self._updates)
+            d, changed = reconcile(self._d, d)
+            self._expose_dict(d, changed)
+        if changed and self._on_reload is not None:
+            self._on_reload(self, changed)
+        return changed
 
-        self._exposed = procdict(self._d)
+    def watch(self, interval=1.0):
+        '''
+        Poll the paths every interval seconds on a daemon thread and reload
+        them when they change. Stop polling with unwatch().
+        @param interval : seconds between polls
+        '''
+        self.__assert_not_frozen()
+        if self._layers is None:
+            raise ConfigError('config was not constructed with reloadable=True')
+        self.unwatch()
+        stop = threading.Event()
+        def poll():
+            while not stop.wait(interval):
+                try:
+                    self.reload()
+                except Exception, e:
+                    self.errors.append('reload - ' + str(e))
+        thread = threading.Thread(target=poll, name='optutils-config-watch')
+        thread.daemon = True
+        thread.start()
+        self._watcher = (thread, stop)
+
+    def unwatch(self):
+        '''Stop polling the paths (see watch).'''
+        if self._watcher is None:
+            return
+        thread, stop = self._watcher
+        self._watcher = None
+        stop.set()
+        if thread is not threading.current_thread():
+            thread.join()
+
+    ## ## private methods ## ##
+    def __path_index(self):
+        index = self._index
+        if index is not None:
+            return index
+        with self._lock:
+            if self._index is None:
+                index = dict()
+                add_paths(index, '/', self._exposed)
+                self._index = index
+            return self._index
+
+    def __reindex(self, changed):
+        '''
+        Bring the path index up to date with the exposed config. The entries
+        at and below the changed paths are replaced and the entries of their
+        ancestors (which are exposed anew) are updated, the rest is shared
+        with the previous exposed config and so still current.
+        @param changed : the paths which changed (see update_paths, reconcile)
+        '''
+        index = self._index
+        for path in changed:
+            old = index.get(path, _missing)
+            if old is not _missing:
+                remove_paths(index, path, old)
+            e = self._exposed
+            index['/'] = e
+            p = '/'
+            for k in split_path(path):
+                if not is_mapping(e) or k not in e:
+                    break
+                e = e[k]
+                p = os.path.join(p, k)
+                index[p] = e
+            else:
+                add_paths(index, path, e)
+
+    def __assert_not_frozen(self):
+        if self._frozen is not None:
+            raise ConfigError('config is frozen')
+
+    def _expose_dict(self, d, changed=()):
+        '''
+        Expose d, the new cascaded config, reusing what was exposed for the
+        parts it shares with the current one and publish both at once.
+        @param d : the new cascaded config
+        @param changed : the paths which changed (see __reindex)
+        '''
+        old, exposed = self._state
+        if self._exposure == 'slots':
+            if exposed is None:
+                exposed = self._compiled.expose(d)
+            else:
+                exposed = self._compiled.expose(d, old, exposed)
+        elif exposed is None:
+            exposed = Section(d)
+        else:
+            exposed = derive_section(exposed, d)
+        self._state = (d, exposed)
+        if self._index is not None:
+            self.__reindex(changed)
 
     def _skeleton(self):
         '''
         produce a skeleton dictionary from the schema (with nones for values)
         '''
-        def proc(t):
-            if   isinstance(t, dict):
-                return procdict(t, dict())
-            elif isinstance(t, list):
-                return list()
-            else:
-                return self.gettype(t)()
-        def procdict(t, d):
-            if UNDEFINED_KEYS in t:
-                return dict()
-            for k,v in t.iteritems():
-                d[k] = proc(v)
-            return d
-        return procdict(self.schema, dict())
+        return self._compiled.skeleton()
 
     def gettype(self, s):
         '''transform a string into a type'''
@@ -280,74 +1467,17 @@ class BaseConfig(object):
         '''
 
         errors = list()
+        max_errors = self._max_errors
 
         def add_error(path, msg):
-            errors.append("%s/ - %s" % (path, msg))
-
-        def proc(v1, v2, path):
-            '''process 2 values assert they are of the same type'''
-            if   isinstance(v1, dict):
-                procdict(v1, v2, path)
-            elif isinstance(v1, list):
-                proclist(v1, v2, path)
-            else:
-                try:
-                    self.gettype(v1)(v2)
-                except Exception, e:
-                    add_error(path, ', '.join(e.args))
+            errors.append("%s/ - %s" % (join_path(path), msg))
+            if max_errors is not None and len(errors) >= max_errors:
+                raise _TooManyErrors()
 
-        def proclist(t, d, path):
-            '''process a list type'''
-            if len(t) != 1:
-                msg = "A list schema should have only one item. Got " + str(t)
-                add_error(path, msg)
-            if not isinstance(d, list):
-                msg = ("Expected a list got %s" % type(d))
-                add_error(path, msg)
-                return
-            v1 = t[0]
-            for i, v2 in enumerate(d):
-                proc(v1, v2, os.path.join(path, str(i)))
-
-        def procdict(t, d, path):
-            '''process a dictionary type'''
-            if not isinstance(d, dict):
-              msg = (
-                "Expected a dict got %s, '%s'\n %s %s" %
-                (type(d), str(d), str(t), str(d))
-              )
-              add_error(path, msg)
-              return
-            tkeys = set(t.keys())
-            dkeys = set(d.keys())
-            if UNDEFINED_KEYS in tkeys:
-                if len(tkeys) != 1:
-                    msg = (
-                        "A dict schema with __undefinedkeys__ should have "
-                        "only one item. Got " + str(t)
-                    )
-                    add_error(path, msg)
-                    return
-                v1 = t[UNDEFINED_KEYS ]
-                for k, v2 in d.iteritems():
-                    proc(v1, v2, os.path.join(path, k))
-            else:
-                badkeys = set()
-                for k in dkeys:
-                    if k not in tkeys:
-                        msg = (
-                          "Unexpected name, '%s'. The name must be in %s"
-                        ) % (k, str(list(tkeys)))
-                        add_error(path, msg)
-                        badkeys.add(k)
-                for k in dkeys:
-                    if k in badkeys:
-                        continue
-                    v1 = t[k]
-                    v2 = d[k]
-                    proc(v1, v2, os.path.join(path, k))
-
-        proc(self.schema, d, '/')
+        try:
+            self._compiled.validate(d, '/', add_error)
+        except _TooManyErrors:
+            errors.append("stopped after %d errors" % len(errors))
         if len(errors) == 0:
             return None
         return errors
@@ -358,41 +1488,9 @@ class BaseConfig(object):
         @param dicts = a sequence of dictionaries
         '''
 
-        def template(t, k):
-            if UNDEFINED_KEYS in t:
-                return t[UNDEFINED_KEYS]
-            return t[k]
-
-        def gettype(item):
-            if isinstance(item, dict):
-                return dict
-            elif isinstance(item, list):
-                return list
-            return self.gettype(item)
-
-        def proc(t, a, v):
-            if isinstance(v, dict):
-                return procdict(t, a, v)
-            elif isinstance(v, list):
-                return proclist(t, a, v)
-            else:
-                return gettype(t)(v)
-
-        def proclist(t, a, d):
-            return [
-                proc(t[0], gettype(t[0])(), v)
-                for v in d
-            ]
-
-        def procdict(t, a, d):
-            for k,v in d.iteritems():
-                item = template(t, k)
-                a[k] = proc(item, a.get(k, gettype(item)()), v)
-            return a
-
+        root = self._compiled
         conf = dict()
         for d in dicts:
             if d['ok']:
-                procdict(self.schema, conf, d['conf'])
+                root.cascade(conf, d['conf'])
         return conf
-
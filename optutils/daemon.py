@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#Author: Tim Henderson
+#Email: tim.tadh@gmail.com
+#For licensing see the LICENSE file in the top level directory.
+
+'''Run a main command in a warm process. serve() imports nothing new per
+invocation: it listens on a unix socket and forks itself for every client, so
+the imports and whatever was set up before calling serve (eg. loading the
+config) are already done. client() forwards its argv, working directory,
+environment and standard in to the daemon and relays the standard out,
+standard error and exit status back. Standard in is only read when the command
+asks for it, so a command which does not read it leaves it to the shell (eg.
+in a while read loop).
+
+ex.
+    if __name__ == '__main__':
+        socket_path = os.environ.get('MYTOOL_SOCKET')
+        if sys.argv[1:] == ['serve']:
+            daemon.serve(main, socket_path)
+        daemon.run(main, sys.argv[1:], socket_path)
+
+Only the python level sys.stdin, sys.stdout and sys.stderr are forwarded.
+Subprocesses started by the command write to the daemon's own streams.'''
+
+import os, sys, errno, signal, socket, struct, marshal, threading, traceback
+import Queue
+
+from . import lib
+
+_header = struct.Struct('!cI')
+_size = struct.Struct('!I')
+
+class Channel(object):
+    '''Frames of (kind, data) over a socket.'''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    def send(self, kind, data=''):
+        with self.lock:
+            self.sock.sendall(_header.pack(kind, len(data)) + data)
+
+    def recvall(self, n):
+        chunks = list()
+        while n > 0:
+            s = self.sock.recv(min(n, 65536))
+            if not s:
+                return None
+            chunks.append(s)
+            n -= len(s)
+        return ''.join(chunks)
+
+    def recv(self):
+        '''@returns : (kind, data) or (None, None) when the peer is gone'''
+        header = self.recvall(_header.size)
+        if header is None:
+            return None, None
+        kind, n = _header.unpack(header)
+        data = self.recvall(n)
+        if data is None:
+            return None, None
+        return kind, data
+
+class Input(object):
+    '''The standard in of a command running in the daemon. Every fill asks the
+    client for at most size bytes (read(n) asks for no more than it needs)
+    so, like a python file, only what was read ahead is taken from the
+    client's standard in.'''
+
+    def __init__(self, channel, size=65536):
+        self.channel = channel
+        self.size = size
+        self.chunks = list()
+        self.eof = False
+        self.softspace = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def isatty(self):
+        return False
+
+    def close(self):
+        pass
+
+    def fill(self, n=None):
+        self.channel.send('N', _size.pack(n or self.size))
+        kind, data = self.channel.recv()
+        if kind == 'I':
+            self.chunks.append(data)
+        else:
+            self.eof = True
+
+    def buffered(self):
+        s = ''.join(self.chunks)
+        self.chunks = [s] if s else list()
+        return s
+
+    def read(self, n=-1):
+        while not self.eof:
+            if n < 0:
+                self.fill()
+                continue
+            have = sum(len(c) for c in self.chunks)
+            if have >= n:
+                break
+            self.fill(n - have)
+        s = self.buffered()
+        if n < 0 or n >= len(s):
+            self.chunks = list()
+            return s
+        self.chunks = [s[n:]]
+        return s[:n]
+
+    def readline(self):
+        while True:
+            s = self.buffered()
+            i = s.find('\n')
+            if i >= 0:
+                self.chunks = [s[i+1:]] if i+1 < len(s) else list()
+                return s[:i+1]
+            if self.eof:
+                self.chunks = list()
+                return s
+            self.fill()
+
+    def readlines(self):
+        return list(self)
+
+class Output(object):
+    '''The standard out (or error) of a command running in the daemon.'''
+
+    def __init__(self, channel, kind, size=65536):
+        self.channel = channel
+        self.kind = kind
+        self.size = size
+        self.pending = list()
+        self.n = 0
+        self.softspace = 0
+
+    def isatty(self):
+        return False
+
+    def write(self, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        self.pending.append(s)
+        self.n += len(s)
+        if self.n >= self.size:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self.pending:
+            s = ''.join(self.pending)
+            self.pending = list()
+            self.n = 0
+            self.channel.send(self.kind, s)
+
+    def close(self):
+        self.flush()
+
+def handle(main, conn):
+    '''Run one invocation of main for the client on conn.'''
+    channel = Channel(conn)
+    kind, data = channel.recv()
+    if kind != 'A':
+        return
+    request = marshal.loads(data)
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    sys.argv = request['argv']
+    sys.stdin = Input(channel)
+    sys.stdout = Output(channel, 'O')
+    sys.stderr = Output(channel, 'R')
+    try:
+        code = main(request['argv'][1:])
+    except SystemExit, e:
+        code = e.code
+    except Exception:
+        traceback.print_exc()
+        code = 1
+    code = lib.exit_status(code)
+    lib.flush()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    channel.send('X', marshal.dumps(code))
+
+def serve(main, socket_path, backlog=64):
+    '''
+    Serve main on the unix socket at socket_path forever. Each client is
+    handled by a forked child of this process. The socket is only accessible
+    to the user running the daemon.
+    @param main : a command made with main or custom_log_main
+    @param socket_path : the path of the unix socket
+    '''
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0077)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+    server.listen(backlog)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while True:
+        try:
+            conn, _ = server.accept()
+        except socket.error, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        lib.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                server.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                handle(main, conn)
+            except Exception:
+                status = 1
+            finally:
+                os._exit(status)
+        conn.close()
+
+def client(socket_path, argv, stdin=None, stdout=None, stderr=None):
+    '''
+    Run argv in the daemon serving socket_path.
+    @param socket_path : the path of the unix socket
+    @param argv : the arguments (without the program name)
+    @returns : the exit status of the command
+    @raises socket.error : if there is no daemon listening
+    '''
+    stdin = sys.stdin if stdin is None else stdin
+    stdout = sys.stdout if stdout is None else stdout
+    stderr = sys.stderr if stderr is None else stderr
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    channel = Channel(sock)
+    channel.send('A', marshal.dumps({
+        'argv': [sys.argv[0]] + list(argv),
+        'cwd': os.getcwd(),
+        'env': dict(os.environ),
+    }))
+
+    # standard in is read on its own thread, and only as much as the daemon
+    # asks for, so the output is relayed while the client waits for input
+    requests = Queue.Queue()
+    def forward():
+        while True:
+            n = requests.get()
+            try:
+                if hasattr(stdin, 'fileno'):
+                    s = os.read(stdin.fileno(), n)
+                else:
+                    s = stdin.read(n)
+            except (IOError, OSError):
+                s = ''
+            try:
+                channel.send('I' if s else 'E', s)
+            except socket.error:
+                return
+            if not s:
+                return
+    thread = threading.Thread(target=forward, name='optutils-daemon-stdin')
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            kind, data = channel.recv()
+            if kind == 'O':
+                stdout.write(data)
+                stdout.flush()
+            elif kind == 'R':
+                stderr.write(data)
+                stderr.flush()
+            elif kind == 'N':
+                requests.put(_size.unpack(data)[0])
+            elif kind == 'X':
+                return marshal.loads(data)
+            else:
+                lib.log('the optutils daemon at %s went away' % socket_path)
+                return 1
+    finally:
+        sock.close()
+
+def run(main, argv, socket_path):
+    '''Run argv in the daemon at socket_path if one is listening, otherwise
+    run main in this process. Exits with the status of the command.'''
+    if socket_path:
+        try:
+            code = client(socket_path, argv)
+        except socket.error, e:
+            if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+                raise
+        else:
+            sys.exit(code)
+    sys.exit(main(argv))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#Author: Tim Henderson
+#Email: tim.tadh@gmail.com
+#For licensing see the LICENSE file in the top level directory.
+
+'''Opt in instrumentation of commands. Set OPTUTILS_PROFILE to a comma
+separated list of:
+
+    time      wall and cpu time of each phase of the command
+    cprofile  time plus the cProfile stats of the command
+    memory    time plus the growth of the max resident set size
+
+The report is logged (to the standard error) after the command finishes.'''
+
+import os, sys, time, contextlib, resource
+import cStringIO as sio
+
+ENV = 'OPTUTILS_PROFILE'
+MODES = ('time', 'cprofile', 'memory')
+
+def modes():
+    '''The instrumentation modes requested in the environment.'''
+    value = os.environ.get(ENV)
+    if not value:
+        return frozenset()
+    requested = frozenset(m.strip().lower() for m in value.split(','))
+    if '1' in requested:
+        requested |= frozenset(['time'])
+    return requested & frozenset(MODES)
+
+# cProfile only supports one active profiler, nested commands are covered by
+# the outer command's stats.
+_profiling = list()
+
+def cpu():
+    t = os.times()
+    return t[0] + t[1]
+
+class Profile(object):
+    '''Records the wall and cpu time of the phases of one command.'''
+
+    def __init__(self, name, modes):
+        self.name = name
+        self.modes = modes
+        self.phases = list()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        wall, clock = time.time(), cpu()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - wall, cpu() - clock))
+
+    def run(self, f, *args, **kwargs):
+        '''Run f (the body of the command) and record it and its phases.'''
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        wall, clock = time.time(), cpu()
+        profiler = None
+        try:
+            if 'cprofile' in self.modes and not _profiling:
+                import cProfile
+                profiler = cProfile.Profile()
+                _profiling.append(profiler)
+                try:
+                    return profiler.runcall(f, *args, **kwargs)
+                finally:
+                    _profiling.pop()
+            return f(*args, **kwargs)
+        finally:
+            self.wall = time.time() - wall
+            self.cpu = cpu() - clock
+            self.rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+            self.profiler = profiler
+
+    def report(self):
+        '''@returns : the lines of the report'''
+        lines = ['profile %s: wall %.6fs cpu %.6fs' % (
+            self.name, self.wall, self.cpu)]
+        wall, clock = self.wall, self.cpu
+        for name, w, c in self.phases:
+            lines.append('    %-10s wall %.6fs cpu %.6fs' % (name, w, c))
+            wall -= w
+            clock -= c
+        lines.append('    %-10s wall %.6fs cpu %.6fs' % ('body', wall, clock))
+        if 'memory' in self.modes:
+            unit = 'bytes' if sys.platform == 'darwin' else 'kB'
+            lines.append('    max rss grew by %d %s' % (self.rss, unit))
+        if self.profiler is not None:
+            import pstats
+            out = sio.StringIO()
+            stats = pstats.Stats(self.profiler, stream=out)
+            stats.sort_stats('cumulative').print_stats(25)
+            lines.extend(out.getvalue().rstrip().split('\n'))
+        return lines
+
+@contextlib.contextmanager
+def noop():
+    yield
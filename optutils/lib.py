@@ -4,7 +4,7 @@
 #Email: tim.tadh@gmail.com
 #For licensing see the LICENSE file in the top level directory.
 
-import os, sys
+import os, sys, json, time, atexit, itertools
 
 error_codes = {
     'usage':1,
@@ -26,8 +26,106 @@ def add_code(name):
     error_codes[name] = _next_code
     _next_code += 1
 
+def exit_status(code):
+    '''The exit status python would use for sys.exit(code).'''
+    if code is None:
+        return 0
+    if isinstance(code, (int, long)):
+        return code
+    print >>sys.stderr, code
+    return 1
+
+class Buffer(object):
+    '''Collects lines for a stream and writes them out in one go according to
+    a flush policy. The stream is looked up on every flush so swapping
+    sys.stdout or sys.stderr is respected.'''
+
+    def __init__(self, getstream, lines=None, size=None, tty=False):
+        '''
+        @param getstream : function () -> the stream to write to
+        @param lines : flush once this many lines are pending
+        @param size : flush once this many bytes are pending
+        @param tty : flush every line when the stream is a terminal
+        If none are given the buffer is only flushed by flush().
+        '''
+        self.getstream = getstream
+        self.lines = lines
+        self.size = size
+        self.tty = tty
+        self.pending = list()
+        self.nlines = 0
+        self.nbytes = 0
+
+    def write(self, s, lines=1):
+        self.pending.append(s)
+        self.nlines += lines
+        self.nbytes += len(s)
+        if ((self.lines is not None and self.nlines >= self.lines) or
+            (self.size is not None and self.nbytes >= self.size) or
+            (self.tty and self.getstream().isatty())):
+            self.flush()
+
+    def flush(self):
+        stream = self.getstream()
+        if self.pending:
+            s = ''.join(self.pending)
+            self.pending = list()
+            self.nlines = 0
+            self.nbytes = 0
+            stream.write(s)
+        stream.flush()
+
+_output_buffer = None
+_log_buffer = None
+
+def buffer_output(lines=None, size=None, tty=False):
+    '''Buffer output (see Buffer for the flush policy). Buffered output is
+    flushed at exit, by flush() and by Util.usage.'''
+    global _output_buffer
+    flush()
+    _output_buffer = Buffer(lambda: sys.stdout, lines, size, tty)
+
+def buffer_log(lines=None, size=None, tty=False):
+    '''Buffer log messages (see buffer_output).'''
+    global _log_buffer
+    flush()
+    _log_buffer = Buffer(lambda: sys.stderr, lines, size, tty)
+
+def unbuffer():
+    '''Flush and go back to writing every message immediately.'''
+    global _output_buffer, _log_buffer
+    flush()
+    _output_buffer = None
+    _log_buffer = None
+
+def flush():
+    '''Flush any buffered output and log messages.'''
+    if _output_buffer is not None:
+        _output_buffer.flush()
+    if _log_buffer is not None:
+        _log_buffer.flush()
+
+atexit.register(flush)
+
+def _line(msgs):
+    '''The line print writes for msgs. Like print there is no space after a
+    message which ends in whitespace other than a space.'''
+    parts = list()
+    space = False
+    for msg in msgs:
+        s = str(msg)
+        if space:
+            parts.append(' ')
+        parts.append(s)
+        space = not s or not s[-1].isspace() or s[-1] == ' '
+    parts.append('\n')
+    return ''.join(parts)
+
 def log(*msgs):
     '''Log a message to the user'''
+    if _log_buffer is not None:
+        _log_buffer.write(_line(msgs))
+        return
     for msg in msgs:
         print >>sys.stderr, str(msg),
     print >>sys.stderr
@@ -35,8 +133,121 @@ def log(*msgs):
 
 def output(*msgs):
     '''Output a piece of data (suitable for piping to others).'''
+    if _output_buffer is not None:
+        _output_buffer.write(_line(msgs))
+        return
     for msg in msgs:
         print >>sys.stdout, str(msg),
     print >>sys.stdout
     sys.stdout.flush()
 
+def output_many(records, chunk=4096):
+    '''Output every record in records on its own line. Records are written
+    in chunks rather than one at a time.
+    @param records : an iterable of things to output
+    @param chunk : the number of records per write
+    '''
+    records = iter(records)
+    while True:
+        lines = [str(r) for r in itertools.islice(records, chunk)]
+        if not lines:
+            break
+        s = '\n'.join(lines) + '\n'
+        if _output_buffer is not None:
+            _output_buffer.write(s, len(lines))
+        else:
+            sys.stdout.write(s)
+    if _output_buffer is None:
+        sys.stdout.flush()
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+levels = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+}
+
+def _suppressed(*args, **kwargs):
+    pass
+
+class Logger(object):
+    '''
+    A leveled logger which writes through log (or any logf). The methods of
+    the levels below the threshold are replaced by a function which does
+    nothing so a suppressed message costs one call: it is never formatted.
+
+    Messages are formatted only when they are written, either as msg % args
+    or, if msg is callable, as msg(). Keyword arguments are structured fields
+    which are appended as key=value (or included in the JSON record).
+
+    ex.
+        logger = Logger('info')
+        logger.debug('state %s', expensive)   # never formatted
+        logger.info(lambda: 'summary %s' % summarize(), n=10)
+
+    A Logger can be used as the logf of custom_log_main. Util only logs the
+    reason it is about to exit through logf so calling a Logger logs at error.
+    '''
+
+    def __init__(self, level=INFO, logf=None, json_lines=False):
+        '''
+        @param level : the threshold, a number or a level name
+        @param logf : the function (*msgs) which writes the messages,
+                      defaults to log.
+        @param json_lines : write each message as a JSON object on its own
+                            line with its time, level, message and fields.
+        '''
+        self.logf = logf
+        self.json_lines = json_lines
+        self.setlevel(level)
+
+    def setlevel(self, level):
+        if isinstance(level, basestring):
+            level = levels[level.lower()]
+        self.level = level
+        for name, value in levels.iteritems():
+            if value < level:
+                setattr(self, name, _suppressed)
+            else:
+                self.__dict__.pop(name, None)
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def write(self, level, msg, args, fields):
+        if callable(msg):
+            msg = msg()
+        if args:
+            msg = msg % args
+        else:
+            msg = str(msg)
+        if self.json_lines:
+            record = dict(fields)
+            record['time'] = time.time()
+            record['level'] = level
+            record['msg'] = msg
+            msg = json.dumps(record, sort_keys=True, default=str)
+        elif fields:
+            msg = ' '.join(
+                [msg] + ['%s=%s' % (k, fields[k]) for k in sorted(fields)])
+        (self.logf or log)(msg)
+
+    def debug(self, msg, *args, **fields):
+        self.write('debug', msg, args, fields)
+
+    def info(self, msg, *args, **fields):
+        self.write('info', msg, args, fields)
+
+    def warning(self, msg, *args, **fields):
+        self.write('warning', msg, args, fields)
+
+    def error(self, msg, *args, **fields):
+        self.write('error', msg, args, fields)
+
+    def __call__(self, *msgs):
+        self.error(' '.join(str(msg) for msg in msgs))
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#Author: Tim Henderson
+#Email: tim.tadh@gmail.com
+#For licensing see the LICENSE file in the top level directory.
+
+'''Compiled config snapshots. A cascaded config is written once into a
+compact binary file which embeds the hash of its schema. Loading a snapshot
+memory maps the file and only decodes the sections which are touched, so
+short lived processes start without parsing anything.
+
+ex.
+    BaseConfig(schema, *paths).write_snapshot('/etc/mytool/config.snap')
+
+    config = snapshot.load('/etc/mytool/config.snap', schema)
+    config.server.port
+
+The format is a header (magic, schema hash, offset of the root) followed by
+tagged values. Dicts and lists refer to their values by offset so any value
+can be decoded on its own. A dict's keys are sorted and indexed by a table of
+fixed size entries so a key of a large dict is found by a binary search in
+the snapshot rather than by building a table of its keys. TypedLists are stored as their machine values so
+a snapshot holding them is only readable on a platform with the same sizes
+and byte order.'''
+
+import os, mmap, array, struct, collections
+
+from .conf import ConfigError, TypedList, compile_schema, default_types
+
+MAGIC = 'OPTSNAP2'
+
+_head = struct.Struct('!8s40sQ')
+_n = struct.Struct('!I')
+_offset = struct.Struct('!Q')
+_int = struct.Struct('!q')
+_float = struct.Struct('!d')
+_array = struct.Struct('!cII')
+_entry = struct.Struct('!QQ')
+
+# dicts with at most this many keys keep a table of their keys once read
+_small = 32
+
+def dump(d, schema_hash):
+    '''
+    Encode a cascaded config.
+    @param d : the cascaded config (BaseConfig._d)
+    @param schema_hash : the hash of its schema (see conf.schema_hash)
+    @returns : the snapshot as a string
+    '''
+    chunks = list()
+    end = [_head.size]
+    def emit(s):
+        offset = end[0]
+        chunks.append(s)
+        end[0] += len(s)
+        return offset
+    def proc(v):
+        if isinstance(v, dict):
+            items = sorted(
+                (k.encode('utf-8') if isinstance(k, unicode) else k, x)
+                for k, x in v.iteritems()
+            )
+            entries = [
+                _entry.pack(emit(_n.pack(len(k)) + k), proc(x))
+                for k, x in items
+            ]
+            return emit(''.join(['D', _n.pack(len(entries))] + entries))
+        elif isinstance(v, TypedList):
+            s = v.tostring()
+            return emit('A' + _array.pack(v.typecode, v.itemsize, len(s)) + s)
+        elif isinstance(v, (list, tuple)):
+            offsets = [proc(x) for x in v]
+            return emit(''.join(
+                ['L', _n.pack(len(offsets))] +
+                [_offset.pack(offset) for offset in offsets]
+            ))
+        elif v is None:
+            return emit('N')
+        elif isinstance(v, bool):
+            return emit('1' if v else '0')
+        elif isinstance(v, int):
+            return emit('I' + _int.pack(v))
+        elif isinstance(v, long):
+            s = str(v)
+            return emit('J' + _n.pack(len(s)) + s)
+        elif isinstance(v, float):
+            return emit('R' + _float.pack(v))
+        elif isinstance(v, str):
+            return emit('S' + _n.pack(len(v)) + v)
+        elif isinstance(v, unicode):
+            s = v.encode('utf-8')
+            return emit('U' + _n.pack(len(s)) + s)
+        raise ConfigError('can not snapshot a value of %s' % type(v))
+    root = proc(d)
+    return _head.pack(MAGIC, schema_hash, root) + ''.join(chunks)
+
+def share(d, schema_hash):
+    '''
+    Encode a cascaded config into an anonymous shared memory map which
+    forked children share with the parent (see BaseConfig.freeze).
+    @returns : (the map, its root SnapshotSection)
+    '''
+    s = dump(d, schema_hash)
+    m = mmap.mmap(-1, len(s))
+    m.write(s)
+    return m, SnapshotSection(m, _head.unpack_from(m, 0)[2])
+
+def write(config, path):
+    '''Write the snapshot of a BaseConfig to path. The file is replaced
+    atomically so running readers never see a partial snapshot.'''
+    if config._frozen is not None:
+        s = config._frozen[:]
+    else:
+        s = dump(config._d, config._compiled.hash)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(s)
+    os.rename(tmp, path)
+
+def decode(m, offset):
+    '''Decode the value at offset. Dicts become (lazy) SnapshotSections and
+    lists become tuples.'''
+    tag = m[offset]
+    offset += 1
+    if tag == 'D':
+        return SnapshotSection(m, offset - 1)
+    elif tag == 'L':
+        n, = _n.unpack_from(m, offset)
+        offset += _n.size
+        return tuple(
+            decode(m, _offset.unpack_from(m, offset + i*_offset.size)[0])
+            for i in xrange(n)
+        )
+    elif tag == 'A':
+        typecode, itemsize, n = _array.unpack_from(m, offset)
+        a = array.array('b' if typecode == '?' else typecode)
+        if a.itemsize != itemsize:
+            raise ConfigError(
+                'the snapshot was made on a platform where %s is %d bytes' % (
+                typecode, itemsize))
+        offset += _array.size
+        a.fromstring(m[offset:offset + n])
+        return TypedList(a, typecode == '?')
+    elif tag == 'N':
+        return None
+    elif tag == '1':
+        return True
+    elif tag == '0':
+        return False
+    elif tag == 'I':
+        return _int.unpack_from(m, offset)[0]
+    elif tag == 'R':
+        return _float.unpack_from(m, offset)[0]
+    elif tag in 'SUJ':
+        n, = _n.unpack_from(m, offset)
+        s = m[offset + _n.size:offset + _n.size + n]
+        if tag == 'U':
+            return s.decode('utf-8')
+        elif tag == 'J':
+            return long(s)
+        return s
+    raise ConfigError('corrupt snapshot, unknown tag %s at %d' % (
+        repr(tag), offset - 1))
+
+class SnapshotSection(collections.Mapping):
+    '''A read only view of a dict in a snapshot with the same interface as
+    conf.Section. Small dicts read their key table on first use, keys of
+    large ones are searched for in the snapshot. Child sections are kept once
+    made.'''
+
+    def __init__(self, m, offset):
+        object.__setattr__(self, '_m', m)
+        object.__setattr__(self, '_o', offset)
+        object.__setattr__(self, '_len', _n.unpack_from(m, offset + 1)[0])
+        object.__setattr__(self, '_k', None)
+        object.__setattr__(self, '_c', dict())
+
+    def _entry(self, i):
+        '''@returns : the key and the offset of the value of entry i'''
+        m = self._m
+        k, v = _entry.unpack_from(m, self._o + 1 + _n.size + i*_entry.size)
+        size, = _n.unpack_from(m, k)
+        return m[k + _n.size:k + _n.size + size], v
+
+    def _find(self, name):
+        '''@returns : the offset of the value of name or None'''
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        elif not isinstance(name, str):
+            return None
+        table = self._k
+        if table is not None:
+            return table.get(name)
+        if self._len <= _small:
+            table = dict(self._entry(i) for i in xrange(self._len))
+            object.__setattr__(self, '_k', table)
+            return table.get(name)
+        lo, hi = 0, self._len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k, v = self._entry(mid)
+            if k < name:
+                lo = mid + 1
+            elif k > name:
+                hi = mid
+            else:
+                return v
+        return None
+
+    def __repr__(self):
+        return str(dict((k, self[k]) for k in self))
+
+    def __getattribute__(self, name):
+        if name in ('_m', '_o', '_len', '_k', '_c', '_entry', '_find'):
+            return super(SnapshotSection, self).__getattribute__(name)
+        if self._find(name) is not None:
+            return self[name]
+        return super(SnapshotSection, self).__getattribute__(name)
+
+    def __setattr__(self, name, value):
+        if self._find(name) is not None:
+            raise TypeError, "Section does not support item assignment"
+        return super(SnapshotSection, self).__setattr__(name, value)
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def __iter__(self):
+        return (self._entry(i)[0] for i in xrange(self._len))
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, name):
+        c = self._c
+        if name in c:
+            return c[name]
+        offset = self._find(name)
+        if offset is None:
+            raise KeyError(name)
+        v = decode(self._m, offset)
+        if isinstance(v, (SnapshotSection, tuple, TypedList)):
+            c[name] = v
+        return v
+
+def open_snapshot(m, schema=None, types=default_types, name='snapshot'):
+    '''
+    @param m : a buffer (mmap or string) holding a snapshot
+    @returns : the root SnapshotSection
+    @raises ConfigError : if m is not a snapshot or, when schema is given,
+                          it was made with a different schema
+    '''
+    try:
+        magic, h, root = _head.unpack_from(m, 0)
+    except struct.error:
+        magic = None
+    if magic != MAGIC:
+        raise ConfigError('%s is not a config snapshot' % name)
+    if schema is not None and compile_schema(schema, types).hash != h:
+        raise ConfigError('%s was made with a different schema' % name)
+    return SnapshotSection(m, root)
+
+class Snapshot(object):
+    '''A config loaded from a snapshot file. It is read only and otherwise
+    offers the same attribute and item access as BaseConfig.'''
+
+    def __init__(self, path, schema=None, types=default_types):
+        '''
+        :param path: the snapshot file
+        :param schema=None: if given the snapshot must have been made with
+                            this schema
+        :param types=default_types: the types the schema is compiled with
+        '''
+        try:
+            with open(path, 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError, mmap.error), e:
+            raise ConfigError('could not read snapshot %s' % path, str(e))
+        self.path = path
+        self.errors = list()
+        self._exposed = open_snapshot(m, schema, types, path)
+
+    def __getattribute__(self, name):
+        if name == '_exposed':
+            return object.__getattribute__(self, name)
+        exposed = object.__getattribute__(self, '_exposed')
+        if name in exposed:
+            return exposed[name]
+        return object.__getattribute__(self, name)
+
+    def __getitem__(self, name):
+        return self._exposed[name]
+
+    def __contains__(self, name):
+        return name in self._exposed
+
+    def __repr__(self):
+        return repr(self._exposed)
+
+    def keys(self):
+        return list(self._exposed)
+
+def load(path, schema=None, types=default_types):
+    '''Load the snapshot at path (see Snapshot).'''
+    return Snapshot(path, schema, types)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#Author: Tim Henderson
+#Email: tim.tadh@gmail.com
+#For licensing see the LICENSE file in the top level directory.
+
+'''Read ahead input streams. A ReadAhead reads (and decompresses) its files on
+a background thread into a bounded queue of chunks so the I/O and the
+decompression overlap with whatever the command does with the data. Several
+files are read one after the other as a single stream. Compression is
+detected from the magic bytes at the start of each file: gzip and bz2 are
+always supported, xz needs lzma (python 3) or backports.lzma.
+
+ex.
+    with util.open_input(argv) as f:
+        for line in f:
+            process(line)
+'''
+
+import zlib, bz2, threading, Queue
+import cStringIO as sio
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+_magic = (
+    ('gzip', '\x1f\x8b'),
+    ('bz2', 'BZh'),
+    ('xz', '\xfd7zXZ\x00'),
+)
+_longest_magic = max(len(magic) for _, magic in _magic)
+
+def compression(head):
+    '''@returns : the compression ('gzip', 'bz2' or 'xz') of the data
+    starting with head or None if it is not compressed'''
+    for name, magic in _magic:
+        if head.startswith(magic):
+            return name
+    return None
+
+def _gzip():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def _xz():
+    if lzma is None:
+        raise IOError('reading xz needs lzma (pip install backports.lzma)')
+    return lzma.LZMADecompressor()
+
+_decompressors = {
+    'gzip': _gzip,
+    'bz2': bz2.BZ2Decompressor,
+    'xz': _xz,
+}
+
+def _ended(d):
+    '''@returns : True if the decompressor d reached the end of its stream'''
+    if hasattr(d, 'eof'):
+        return d.eof
+    if isinstance(d, bz2.BZ2Decompressor):
+        try:
+            d.decompress('')
+        except EOFError:
+            return True
+        return False
+    # zlib keeps the input after the end of the stream as unused_data
+    probe = d.copy()
+    try:
+        probe.decompress('\0')
+    except zlib.error:
+        return False
+    return probe.unused_data == '\0'
+
+def decompressed(f, chunk_size=65536):
+    '''
+    Read f in chunks, decompressing it if it starts with the magic bytes of
+    a supported compression. Concatenated compressed streams (eg. from
+    cat a.gz b.gz) are decompressed one after the other.
+    @param f : a file like object opened in binary mode
+    @returns iterator : of the (decompressed) chunks
+    @raises IOError : if the last compressed stream is truncated
+    '''
+    data = f.read(max(chunk_size, _longest_magic))
+    kind = compression(data)
+    if kind is None:
+        while data:
+            yield data
+            data = f.read(chunk_size)
+        return
+    new = _decompressors[kind]
+    d = new()
+    while True:
+        if not data:
+            data = f.read(chunk_size)
+            if not data:
+                if not _ended(d):
+                    raise IOError('unexpected end of %s data' % kind)
+                break
+        try:
+            out = d.decompress(data)
+        except EOFError:
+            # the previous stream ended exactly at the end of a chunk
+            d = new()
+            continue
+        if out:
+            yield out
+        data = d.unused_data
+        if data:
+            d = new()
+
+class _Failure(object):
+
+    def __init__(self, name, error):
+        self.name = name
+        self.error = error
+
+class ReadAhead(object):
+    '''A read only file like object over the concatenated (decompressed)
+    contents of some files. At most depth chunks are read ahead.
+
+    As with python's files, mixing iteration with the read methods is not
+    supported.'''
+
+    def __init__(self, files, chunk_size=65536, depth=16, on_error=None):
+        '''
+        @param files : a list of (name, file like object, close) where close
+                       says if the file should be closed once read
+        @param chunk_size : the size of the reads from the files
+        @param depth : the number of chunks to read ahead
+        @param on_error : a function (name, error) called by the read which
+                          reached a file that could not be read. Afterwards
+                          (or if it returns) an IOError is raised.
+        '''
+        self.files = files
+        self.chunk_size = chunk_size
+        self.on_error = on_error
+        self.queue = Queue.Queue(depth)
+        self.stopped = threading.Event()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.closed = False
+        self.softspace = 0
+        self.thread = threading.Thread(
+            target=self.run, name='optutils-read-ahead')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        files = iter(self.files)
+        try:
+            for name, f, close in files:
+                try:
+                    for chunk in decompressed(f, self.chunk_size):
+                        if not self.put(chunk):
+                            return
+                except Exception, e:
+                    self.put(_Failure(name, e))
+                    return
+                finally:
+                    if close:
+                        f.close()
+            self.put(None)
+        finally:
+            for name, f, close in files:
+                if close:
+                    f.close()
+
+    def put(self, item):
+        '''@returns : False if the stream was closed before item was queued'''
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, True, .1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def fill(self):
+        '''Make the next chunk the buffer.
+        @returns : False at the end of the stream'''
+        if self.eof:
+            return False
+        item = self.queue.get()
+        if item is None:
+            self.eof = True
+            return False
+        elif isinstance(item, _Failure):
+            self.eof = True
+            self.close()
+            if self.on_error is not None:
+                self.on_error(item.name, item.error)
+            raise IOError('could not read %s: %s' % (item.name, item.error))
+        self.buf = item
+        self.pos = 0
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.eof = True
+            self.stopped.set()
+
+    def isatty(self):
+        return False
+
+    def chunks(self):
+        '''@returns iterator : of the chunks of the stream as they were read'''
+        if self.pos < len(self.buf):
+            yield self.buf[self.pos:]
+            self.pos = len(self.buf)
+        while self.fill():
+            self.pos = len(self.buf)
+            yield self.buf
+
+    def read(self, n=-1):
+        parts = list()
+        while n != 0:
+            if self.pos >= len(self.buf) and not self.fill():
+                break
+            if n < 0:
+                part = self.buf[self.pos:]
+            else:
+                part = self.buf[self.pos:self.pos + n]
+                n -= len(part)
+            self.pos += len(part)
+            parts.append(part)
+        return ''.join(parts)
+
+    def readline(self):
+        parts = list()
+        while True:
+            if self.pos >= len(self.buf) and not self.fill():
+                break
+            i = self.buf.find('\n', self.pos)
+            if i >= 0:
+                parts.append(self.buf[self.pos:i + 1])
+                self.pos = i + 1
+                break
+            parts.append(self.buf[self.pos:])
+            self.pos = len(self.buf)
+        return ''.join(parts)
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            if self.pos >= len(self.buf) and not self.fill():
+                return
+            start = self.pos
+            end = self.buf.rfind('\n') + 1
+            if end <= start:
+                # the line continues in the next chunk
+                yield self.readline()
+                continue
+            self.pos = end
+            for line in sio.StringIO(self.buf[start:end]):
+                yield line
@@ -4,10 +4,12 @@
 #Email: tim.tadh@gmail.com
 #For licensing see the LICENSE file in the top level directory.
 
-import os, sys, functools
+import os, sys, mmap, shlex, functools, importlib, itertools, traceback
+import collections
 from getopt import getopt, GetoptError
 
-from .lib import log, output, error_codes
+from .lib import log, output, output_many, error_codes, flush, exit_status
+from . import instrument
 
 def format_long(msg):
     def count_spaces(line):
@@ -44,8 +46,17 @@ def make_command(commands, logf):
         util = Util(short_msg, format_long(long_message), logf)
         parser = parse_args(short_opts, long_opts, util)
         def command(f):
+            # asyncio.coroutine (and trollius) mark coroutine functions with
+            # _is_coroutine. Checking it first keeps commands which are not
+            # async from importing asyncio.
+            if getattr(f, '_is_coroutine', False):
+                from . import aio
+                f = aio.synchronous(f)
             @functools.wraps(f)
             def run_command(argv, *args, **kwargs):
+                modes = instrument.modes()
+                if modes:
+                    return util.profiled(f, modes, parser, argv, *args, **kwargs)
                 return f(argv, util, parser, *args, **kwargs)
             if commands is not None:
                 commands[f.func_name] = run_command
@@ -57,6 +68,78 @@ def make_command(commands, logf):
 main = make_command(None, log)
 custom_log_main = lambda logf: make_command(None, logf)
 
+_batch = None
+
+def _invoke(command):
+    '''run a command of a batch in a pool process (see Util.run_batch)'''
+    util, args, kwargs = _batch
+    lineno, argv = command
+    return lineno, util.invoke(argv, *args, **kwargs)
+
+_mapper = None
+
+def _map(f, start, records):
+    '''
+    Apply f to records, numbered from start, stopping at the first failure.
+    @returns : (the results, None or the failure (number, kind, value)) where
+               kind is 'exit' (value is the exit code) or 'error' (value is
+               the formatted traceback)
+    '''
+    results = list()
+    for i, record in enumerate(records, start):
+        try:
+            results.append(f(record))
+        except SystemExit, e:
+            return results, (i, 'exit', e.code)
+        except Exception:
+            return results, (i, 'error', traceback.format_exc())
+    return results, None
+
+def _map_chunk(chunk):
+    '''map a chunk of records in a pool process (see Util.map_records)'''
+    start, records = chunk
+    return _map(_mapper, start, records)
+
+class LazyCommand(object):
+    '''A command registered by name and loaded (imported) only when it is
+    run or its help is listed. See Util.lazy_command.'''
+
+    def __init__(self, util, name, loader, short_msg=None):
+        self.owner = util
+        self.name = name
+        self.loader = loader
+        self.short_msg = short_msg
+        self.command = None
+
+    def resolve(self):
+        '''@returns : the command, imported on the first call
+        @raises ImportError, AttributeError : if it can not be loaded'''
+        if self.command is None:
+            if callable(self.loader):
+                self.command = self.loader()
+            else:
+                module, _, attr = self.loader.partition(':')
+                self.command = getattr(
+                    importlib.import_module(module), attr or self.name)
+        return self.command
+
+    def load(self):
+        '''@returns : the command, exits with error_codes['bad_module'] if it
+        can not be loaded'''
+        try:
+            return self.resolve()
+        except (ImportError, AttributeError), e:
+            self.owner.log('could not load command %s from %s: %s' % (
+                self.name, self.loader, e))
+            self.owner.usage(error_codes['bad_module'])
+
+    @property
+    def util(self):
+        return self.load().util
+
+    def __call__(self, argv, *args, **kwargs):
+        return self.load()(argv, *args, **kwargs)
+
 class Util(object):
 
     def __init__(self, short_msg, long_msg, logf):
@@ -65,6 +148,51 @@ class Util(object):
         self.long_msg = long_msg
         self.commands = dict()
         self.command = make_command(self.commands, self.log)
+        self.profile = None
+
+    def phase(self, name):
+        '''A context manager which times a phase of the command (eg. loading
+        the config) when the command is instrumented (see
+        optutils.instrument). Otherwise it does nothing.
+
+        ex.
+            with util.phase('config'):
+                config = BaseConfig(schema, *paths)
+        '''
+        if self.profile is None:
+            return instrument.noop()
+        return self.profile.phase(name)
+
+    def profiled(self, f, modes, parser, argv, *args, **kwargs):
+        '''Run the command f while recording the time of option parsing,
+        the phases and the body. The report is logged afterwards.'''
+        def timed_parser(argv):
+            with self.phase('options'):
+                return parser(argv)
+        outer = self.profile
+        self.profile = instrument.Profile(f.func_name, modes)
+        try:
+            return self.profile.run(f, argv, self, timed_parser, *args, **kwargs)
+        finally:
+            profile, self.profile = self.profile, outer
+            self.log('\n'.join(profile.report()))
+
+    def lazy_command(self, name, loader, short_msg=None):
+        '''Register a command without importing it. It is loaded when
+        run_command selects it or when usage() lists it (unless short_msg is
+        given). usage() lists a command which fails to load as such.
+
+        ex.
+            util.lazy_command('build', 'mytool.build:build', 'build the thing')
+
+        @param name : the command name
+        @param loader : "module:attr" where attr is a command made with main
+                        or custom_log_main (attr defaults to name), or a
+                        function () -> command
+        @param short_msg : the one line description shown by usage()
+        '''
+        name = name.replace('-', '_')
+        self.commands[name] = LazyCommand(self, name, loader, short_msg)
 
     def run_command(self, argv, *args, **kwargs):
         if len(argv) < 1:
@@ -74,12 +202,172 @@ class Util(object):
         command_name = argv[0].replace('-', '_')
 
         if command_name in self.commands:
-            self.commands[command_name](argv[1:], *args, **kwargs)
+            command = self.commands[command_name]
+            if isinstance(command, LazyCommand):
+                with self.phase('dispatch'):
+                    command = command.load()
+            result = command(argv[1:], *args, **kwargs)
+            if getattr(command, '_is_coroutine', False):
+                from . import aio
+                if aio.iscoroutine(result):
+                    # an async command run from a running event loop (see
+                    # aio.synchronous), the caller waits on it
+                    return result
         else:
             self.log("no such command %s" % command_name)
             self.log(str(self.commands.keys()))
             self.usage(error_codes['option'])
 
+    def invoke(self, argv, *args, **kwargs):
+        '''Run one command like run_command but return its exit status
+        instead of letting usage() (or any sys.exit) end the program.
+        Exceptions are printed to the standard error and give status 1.'''
+        try:
+            self.run_command(argv, *args, **kwargs)
+            code = 0
+        except SystemExit, e:
+            code = exit_status(e.code)
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        flush()
+        return code
+
+    def run_batch(self, f, processes=1, *args, **kwargs):
+        '''
+        Run many commands in this process. Each line of f is split like a
+        shell command line and run through run_command. Blank lines and #
+        comments are skipped. A failing command (or one which calls usage)
+        only ends that invocation and its failure is logged. A line which
+        can't be split (eg. an unclosed quote) fails with
+        error_codes['option'].
+
+        ex.
+            with util.getfile(path, 'r', sys.stdin) as f:
+                codes = util.run_batch(f, 4)
+
+        @param f : a file like object of command lines
+        @param processes : run the commands on a pool of this many forked
+                           processes. Results are still in line order but
+                           the output of different commands may interleave.
+        @param *args, **kwargs : passed to every command
+        @returns : a list of (line number, exit status)
+        '''
+        malformed = list()
+        def commands():
+            for lineno, line in enumerate(f, 1):
+                try:
+                    argv = shlex.split(line, comments=True)
+                except ValueError, e:
+                    self.log('batch line %d could not be parsed: %s' % (
+                        lineno, e))
+                    malformed.append((lineno, error_codes['option']))
+                    continue
+                if argv:
+                    yield lineno, argv
+        if processes > 1:
+            import multiprocessing
+            global _batch
+            flush()
+            _batch = (self, args, kwargs)
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = list(pool.imap(_invoke, commands(), 16))
+            finally:
+                pool.close()
+                pool.join()
+                _batch = None
+        else:
+            results = [
+                (lineno, self.invoke(argv, *args, **kwargs))
+                for lineno, argv in commands()
+            ]
+        if malformed:
+            results = sorted(results + malformed)
+        for lineno, code in results:
+            if code != 0:
+                self.log('batch line %d exited with %d' % (lineno, code))
+        return results
+
+    def map_records(self, f, records, processes=None, chunk_size=256,
+                    in_flight=None):
+        '''
+        Output f(record) for every record, computed on a pool of processes.
+        The results are output in the order of the records. Records are
+        sent to the pool in chunks and at most in_flight chunks are out at
+        once, reading more records only as the oldest chunk is output.
+        Results which are None are not output.
+
+        Fails fast: if f exits (eg. by calling usage) this exits with the same
+        code, if it raises the error is logged and this exits with
+        error_codes['bad_file_read']. The results of the records before the
+        failing one are output first.
+
+        ex.
+            with util.getfile(path, 'r', sys.stdin) as f:
+                util.map_records(transform, f)
+
+        @param f : a function record -> result. The pool is forked so f does
+                   not need to be picklable but the records and results do.
+        @param records : an iterable of records (eg. a file)
+        @param processes : the size of the pool, defaults to the number of
+                           cpus. With 1 the records are mapped in this
+                           process.
+        @param chunk_size : the number of records per chunk
+        @param in_flight : the number of chunks out at once, defaults to
+                           twice the number of processes
+        '''
+        import multiprocessing
+        global _mapper
+        def chunks():
+            it = iter(records)
+            start = 1
+            while True:
+                chunk = list(itertools.islice(it, chunk_size))
+                if not chunk:
+                    return
+                yield start, chunk
+                start += len(chunk)
+        def emit(results, failure):
+            output_many(r for r in results if r is not None)
+            if failure is None:
+                return
+            i, kind, value = failure
+            if kind == 'exit':
+                flush()
+                sys.exit(value)
+            self.log(value.rstrip('\n'))
+            self.log('Error mapping record %d.' % i)
+            self.usage(error_codes['bad_file_read'])
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if processes <= 1:
+            for start, chunk in chunks():
+                emit(*_map(f, start, chunk))
+            return
+        if in_flight is None:
+            in_flight = 2*processes
+        flush()
+        _mapper = f
+        pool = multiprocessing.Pool(processes)
+        done = False
+        try:
+            pending = collections.deque()
+            for chunk in chunks():
+                if len(pending) >= in_flight:
+                    emit(*pending.popleft().get())
+                pending.append(pool.apply_async(_map_chunk, (chunk,)))
+            while pending:
+                emit(*pending.popleft().get())
+            done = True
+        finally:
+            if done:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+            _mapper = None
+
     def usage(self, code=None):
         '''Prints the usage and exits with an error code specified by code. If
         code is not given it exits with error_codes['usage']'''
@@ -91,9 +379,20 @@ class Util(object):
                 output()
                 output('Commands')
                 for name, cmd in self.commands.iteritems():
-                    output(' '*4, "%-15s" % name, ' '*12, cmd.util.short_msg[:50])
+                    short_msg = getattr(cmd, 'short_msg', None)
+                    if short_msg is None and isinstance(cmd, LazyCommand):
+                        # a command which can't be loaded should not stop the
+                        # listing, running it still fails (see load)
+                        try:
+                            cmd = cmd.resolve()
+                        except Exception:
+                            short_msg = '(could not be loaded)'
+                    if short_msg is None:
+                        short_msg = cmd.util.short_msg
+                    output(' '*4, "%-15s" % name, ' '*12, short_msg[:50])
                 output()
             code = error_codes['usage']
+        flush()
         sys.exit(code)
 
     def assert_file_exists(self, path):
@@ -153,6 +452,125 @@ class Util(object):
             self.usage(error_codes['bad_file_read'])
         return s
 
+    def map_file_or_die(self, path):
+        '''Memory maps the file read only, if there is an error it kills the
+        program. The pages are read in by the OS as they are touched.
+        @param path : the path to the file
+        @returns mmap : the mapped file (supports slicing, find, readline...)
+                        an empty string for an empty file.
+        '''
+        path = self.assert_file_exists(path)
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return ''
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.log('Error reading file at "%s".' % path)
+            self.usage(error_codes['bad_file_read'])
+
+    def view_file_or_die(self, path, offset=0, size=None):
+        '''A zero copy, read only buffer over (part of) the file. if there is
+        an error it kills the program.
+        @param path : the path to the file
+        @param offset : the first byte of the view
+        @param size : the number of bytes in the view (default: to the end)
+        @returns buffer : slices of the buffer copy only the bytes sliced
+        '''
+        m = self.map_file_or_die(path)
+        if size is None:
+            return buffer(m, offset)
+        return buffer(m, offset, size)
+
+    def iter_file_or_die(self, path, buffer_size=65536, lines=False):
+        '''Iterates over the file in constant memory. if there is an error it
+        kills the program.
+        @param path : the path to the file
+        @param buffer_size : the size of the chunks read from the file
+        @param lines : if True yield lines instead of chunks
+        @returns iterator : of chunks of at most buffer_size bytes or of lines
+        '''
+        path = self.assert_file_exists(path)
+        try:
+            f = open(path, 'rb', buffer_size)
+        except Exception:
+            self.log('Error reading file at "%s".' % path)
+            self.usage(error_codes['bad_file_read'])
+        def chunks():
+            with f:
+                try:
+                    if lines:
+                        for line in f:
+                            yield line
+                    else:
+                        while True:
+                            chunk = f.read(buffer_size)
+                            if not chunk:
+                                break
+                            yield chunk
+                except (IOError, OSError):
+                    self.log('Error reading file at "%s".' % path)
+                    self.usage(error_codes['bad_file_read'])
+        return chunks()
+
+    def read_file_async(self, path):
+        '''read_file_or_die in a thread (see optutils.aio).
+        @returns : a future of the contents of the file
+        '''
+        from . import aio
+        return aio.run_in_thread(self.read_file_or_die, path)
+
+    def getfile_async(self, path, mode, default):
+        '''getfile in a thread (see optutils.aio).
+        @returns : a future of the file like object
+        '''
+        from . import aio
+        return aio.run_in_thread(self.getfile, path, mode, default)
+
+    def open_input(self, paths=None, default=None, chunk_size=65536,
+                   read_ahead=16):
+        '''Open the paths (or default) as one read only stream which is read
+        and decompressed (gzip, bz2 and, if lzma is available, xz) ahead on
+        a background thread (see optutils.stream). If there is an error it
+        kills the program.
+
+        ex.
+            with util.open_input(argv) as f:
+                for line in f:
+                    process(line)
+
+        @param paths : a path, a list of paths or None. Uses the default if
+                       there are none. A path of '-' is the default.
+        @param default : a file like object, defaults to sys.stdin
+        @param chunk_size : the size of the reads from the files
+        @param read_ahead : the number of chunks to read ahead
+        @returns stream.ReadAhead : a file like object
+        '''
+        from . import stream
+        if default is None:
+            default = sys.stdin
+        if isinstance(paths, basestring):
+            paths = [paths]
+        if not paths:
+            paths = [None]
+        files = list()
+        for path in paths:
+            if path is None or path == '-':
+                files.append(('<stdin>', self.getfile(None, 'rb', default), False))
+                continue
+            path = self.assert_file_exists(path)
+            try:
+                files.append((path, self.getfile(path, 'rb', default), True))
+            except Exception:
+                for _, f, close in files:
+                    if close: f.close()
+                self.log('Error reading file at "%s".' % path)
+                self.usage(error_codes['bad_file_read'])
+        def on_error(name, e):
+            self.log('Error reading file at "%s". %s' % (name, e))
+            self.usage(error_codes['bad_file_read'])
+        return stream.ReadAhead(files, chunk_size, read_ahead, on_error)
+
     def parse_int(self, s):
         '''Try and parse an int. die on failure.
         @param s : a string
@@ -9,6 +9,6 @@ setup(name='optutils',
       author_email='tim.tadh@gmail.com',
       url='https://www.github.com/timtadh/optutils',
       license='GPL',
-      packages=['optutils'],
+      packages=['optutils', 'optutils.benchmarks'],
 )
 
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#Author: Tim Henderson
+#Email: tim.tadh@gmail.com
+#For licensing see the LICENSE file in the top level directory.
+
+import os, json, random, shutil, tempfile, unittest
+
+from optutils import conf
+
+class TestStreamJsonParser(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, text):
+        path = os.path.join(self.dir, 'conf.json')
+        with open(path, 'wb') as f:
+            f.write(text)
+        return path
+
+    def check(self, text):
+        path = self.write(text)
+        expected = conf.json_parser(path)
+        for chunk_size in (1, 2, 3, 5, 7, 16, 64, 65536):
+            self.assertEqual(
+                conf.stream_json_parser(path, chunk_size), expected,
+                'chunk_size %d: %s' % (chunk_size, text))
+
+    def test_numbers_cut_at_chunk_boundaries(self):
+        self.check('{"a": 1.5e10, "b": 1}')
+        self.check('{"a":-12.25E-3,"b":[1,2.5],"c":1e+5}')
+        self.check('{"a": 10}')
+
+    def test_values(self):
+        self.check('{}')
+        self.check('{"a": {"b": [true, false, null]}, "c": "d\\u00e9"}')
+
+    def test_random_documents(self):
+        r = random.Random(7)
+        def value(depth):
+            kind = r.randint(0, 5 if depth < 3 else 3)
+            if kind == 0:
+                return r.randint(-10**6, 10**6)
+            elif kind == 1:
+                return r.uniform(-1e12, 1e12)
+            elif kind == 2:
+                return r.choice([True, False, None])
+            elif kind == 3:
+                return 'x' * r.randint(0, 8)
+            elif kind == 4:
+                return [value(depth + 1) for _ in xrange(r.randint(0, 4))]
+            return dict(
+                ('k%d' % i, value(depth + 1)) for i in xrange(r.randint(0, 4)))
+        for _ in xrange(50):
+            d = dict(('k%d' % i, value(0)) for i in xrange(r.randint(0, 6)))
+            self.check(json.dumps(d, separators=r.choice([(',', ':'), None])))
+
+class TestReload(unittest.TestCase):
+
+    schema = {'a': 'int', 'b': 'int', 'c': 'int'}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(text)
+        return path
+
+    def test_good_edit_after_bad_edit(self):
+        a = self.write('a.json', '{"a": 1, "b": 1}')
+        b = self.write('b.json', '{"b": 2}')
+        c = conf.BaseConfig(self.schema, a, b, reloadable=True)
+        self.write('a.json', '{bad')
+        self.assertEqual(c.reload(), list())
+        self.assertTrue(c.errors)
+        self.write('b.json', '{"b": 30}')
+        self.assertEqual(c.reload(), ['/b'])
+        self.assertEqual((c.a, c.b), (1, 30))
+
+    def test_updates_are_reapplied(self):
+        a = self.write('a.json', '{"a": 1}')
+        c = conf.BaseConfig(self.schema, a, reloadable=True)
+        c.update({'b': 2})
+        c.update({'c': 3})
+        c.update({'b': 4})
+        self.write('a.json', '{"a": 10}')
+        self.assertEqual(c.reload(), ['/a'])
+        self.assertEqual((c.a, c.b, c.c), (10, 4, 3))
+
+if __name__ == '__main__':
+    unittest.main()